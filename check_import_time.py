@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for the CI Rescue modules
+"""
+
+import os
+import subprocess
+import sys
+
+# Modules whose import cost is guarded; main must stay cheap to import
+MODULES = ("main", "annotations", "github_client", "openrouter_client")
+# Cumulative import time allowed for any single module, in microseconds
+BUDGET_US = 500_000
+
+
+def cumulative_import_times(module: str) -> dict:
+    """Import a module in a fresh interpreter and return each import's cumulative time"""
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONPATH": src},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> int:
+    over_budget = False
+    for module in MODULES:
+        times = cumulative_import_times(module)
+        total = times[module]
+        status = "✅" if total <= BUDGET_US else "❌"
+        print(f"{status} {module}: {total / 1000:.1f} ms (budget {BUDGET_US / 1000:.0f} ms)")
+        if total > BUDGET_US:
+            over_budget = True
+            slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[1:6]
+            for name, cumulative in slowest:
+                print(f"   {cumulative / 1000:8.1f} ms  {name}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
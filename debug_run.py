@@ -4,31 +4,54 @@ Quick script to analyze GitHub Actions run failure
 """
 
 import os
-import requests
-import json
+import sys
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+from constants import JOB_LOGS_URL_T
+from github_client import (
+    FAILED_JOB_CONCLUSIONS,
+    REQUEST_TIMEOUT,
+    create_session,
+    fetch_jobs,
+    read_log_tail,
+)
 
 # GitHub API configuration
 GITHUB_TOKEN = os.getenv('GH_TOKEN_MAX')
 RUN_ID = '16603415771'
 REPO = 'pbitkowski/ci-rescue-action'
 
+# One keep-alive, retrying session for every request in this script
+SESSION = create_session(GITHUB_TOKEN)
+
+# Job logs already downloaded in this process, keyed by job id
+LOG_CACHE = {}
+
+def get_job_logs(job_id):
+    """Get the tail of a job's logs, downloading them at most once"""
+    if job_id not in LOG_CACHE:
+        logs_url = JOB_LOGS_URL_T.format(repo=REPO, job_id=job_id)
+        with SESSION.get(logs_url, stream=True, timeout=REQUEST_TIMEOUT) as logs_response:
+            if logs_response.status_code != 200:
+                return None
+            LOG_CACHE[job_id] = read_log_tail(logs_response)
+    return LOG_CACHE[job_id]
+
 def get_run_details():
     """Get workflow run details"""
-    headers = {
-        'Authorization': f'token {GITHUB_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
-    
     # Get run details
     url = f'https://api.github.com/repos/{REPO}/actions/runs/{RUN_ID}'
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
     
     if response.status_code != 200:
         print(f"Error getting run details: {response.status_code}")
         print(response.text)
         return
     
-    run_data = response.json()
+    run_data = orjson.loads(response.content)
     print(f"🔍 Workflow Run: {run_data['name']}")
     print(f"📅 Created: {run_data['created_at']}")
     print(f"📊 Status: {run_data['status']} / {run_data['conclusion']}")
@@ -37,29 +60,24 @@ def get_run_details():
     print("\n" + "="*60 + "\n")
     
     # Get jobs for this run
-    jobs_url = f'https://api.github.com/repos/{REPO}/actions/runs/{RUN_ID}/jobs'
-    jobs_response = requests.get(jobs_url, headers=headers)
+    status, jobs_data = fetch_jobs(REPO, RUN_ID, SESSION)
     
-    if jobs_response.status_code != 200:
-        print(f"Error getting jobs: {jobs_response.status_code}")
+    if status != 200:
+        print(f"Error getting jobs: {status}")
         return
     
-    jobs_data = jobs_response.json()
-    
     for job in jobs_data['jobs']:
         print(f"🔧 Job: {job['name']}")
         print(f"   Status: {job['status']} / {job['conclusion']}")
         print(f"   Started: {job['started_at']}")
         
-        if job['conclusion'] in ['failure', 'cancelled']:
+        if job['conclusion'] in FAILED_JOB_CONCLUSIONS:
             print(f"   ❌ FAILED")
             
             # Get job logs
-            logs_url = f"https://api.github.com/repos/{REPO}/actions/jobs/{job['id']}/logs"
-            logs_response = requests.get(logs_url, headers=headers)
+            logs = get_job_logs(job['id'])
             
-            if logs_response.status_code == 200:
-                logs = logs_response.text
+            if logs is not None:
                 print(f"   📋 Logs (last 1000 chars):")
                 print("   " + "-" * 50)
                 # Show last part of logs where errors usually are
@@ -71,7 +89,7 @@ def get_run_details():
             
             # Show failed steps
             print(f"   🔍 Steps:")
-            for step in job.get('steps', []):
+            for step in job.get('steps', ()):
                 status_icon = "✅" if step['conclusion'] == 'success' else "❌" if step['conclusion'] == 'failure' else "⏸️"
                 print(f"     {status_icon} {step['name']} ({step.get('conclusion', 'unknown')})")
                 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Parsing and rendering of AI analyses for CI Rescue
+"""
+
+from typing import List, Optional
+import orjson
+from debug import debug
+from models import FailureInfo
+
+# Delimits the JSON annotations block in an AI response
+ANNOTATIONS_MARKER = "<<<CI-RESCUE-ANNOTATIONS>>>"
+# Emoji shown for each annotation level
+LEVEL_EMOJI = {
+    'failure': '❌',
+    'error': '🚨',
+    'warning': '⚠️',
+    'notice': 'ℹ️'
+}
+
+
+def parse_analysis(analysis_text: str) -> (str, Optional[List[dict]]):
+    """Parse the AI response to separate the comment from annotations."""
+    debug(f"🔍 Parsing AI response for annotations (length: {len(analysis_text)} chars)...")
+
+    comment, sep, after = analysis_text.partition(ANNOTATIONS_MARKER)
+    if not sep:
+        debug("ℹ️  No annotation markers found in AI response")
+        return analysis_text, None
+
+    debug("📍 Found annotation marker in AI response")
+    # The JSON block sits between the opening and the closing marker
+    annotations_json_str, _, rest = after.partition(ANNOTATIONS_MARKER)
+    debug(f"📋 Raw annotation JSON: {annotations_json_str[:200]}..." if len(annotations_json_str) > 200 else f"📋 Raw annotation JSON: {annotations_json_str}")
+
+    try:
+        annotations_data = orjson.loads(annotations_json_str)
+        annotations = annotations_data.get("annotations")
+
+        if annotations:
+            print(f"✅ Successfully parsed {len(annotations)} annotation(s)")
+            for i, annotation in enumerate(annotations):
+                debug(f"   📌 Annotation {i+1}: {annotation.get('path', 'unknown')}:{annotation.get('start_line', 'unknown')} - {annotation.get('message', 'no message')[:50]}...")
+        else:
+            print("⚠️  No annotations found in parsed JSON")
+
+        return comment.strip(), annotations
+
+    except (orjson.JSONDecodeError, AttributeError) as e:
+        print(f"❌ Failed to parse annotation JSON: {e}")
+        print(f"   Raw content: {annotations_json_str[:100]}...")
+        return comment + annotations_json_str + rest, None
+
+
+def render_annotations(annotations: List[dict]) -> (str, List[dict]):
+    """Render annotations as a markdown section and as GitHub review comments in one pass"""
+    debug(f"📝 Formatting {len(annotations)} annotations for PR comment")
+
+    parts = ["\n\n## 📍 **Code Annotations**\n\n"]
+    review_comments = []
+
+    for annotation in annotations:
+        path = annotation.get('path', '')
+        start_line = annotation.get('start_line', annotation.get('line'))
+        end_line = annotation.get('end_line', start_line)
+        message = annotation.get('message', 'No message provided')
+        level_emoji = LEVEL_EMOJI.get(annotation.get('annotation_level', 'notice'), '📝')
+
+        if start_line is None:
+            line_info = "Line unknown"
+        elif start_line == end_line:
+            line_info = f"Line {start_line}"
+        else:
+            line_info = f"Lines {start_line}-{end_line}"
+        parts.append(f"{level_emoji} **{path or 'unknown file'}** ({line_info})\n   {message}\n\n")
+
+        # Review comments must point at a real file and line
+        if not path:
+            print(f"⚠️  Skipping annotation without path: {annotation}")
+            continue
+        try:
+            line = int(1 if start_line is None else start_line)
+        except (ValueError, TypeError):
+            print(f"⚠️  Invalid line number in annotation: {annotation}")
+            continue
+        review_comments.append({
+            'path': path,
+            'line': line,
+            'body': f"{level_emoji} **CI Rescue Analysis**\n\n{message}"
+        })
+
+    debug(f"🔍 Converted {len(annotations)} annotations to {len(review_comments)} review comments")
+    return "".join(parts), review_comments
+
+
+def failure_summary(failures: List[FailureInfo]) -> str:
+    """Create summary of failures that were not analyzed themselves"""
+    other_failures = "\n".join([
+        f"- **{f.job_name}** → {f.step_name} ({f.conclusion})"
+        for f in failures
+    ])
+    return f"\n\n**Additional Failures:**\n{other_failures}"
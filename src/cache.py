@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Persistent caches for CI Rescue
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Union
+
+# Analyses older than this are asked for again; models and prompts move on
+ANALYSIS_TTL = 7 * 24 * 3600
+
+
+class _SQLiteCache:
+    """Lazily opened SQLite database holding a single cache table"""
+
+    NAME = ""
+    FILENAME = ""
+    SCHEMA = ""
+
+    def __init__(self, cache_dir: str):
+        self.path = os.path.join(cache_dir, self.FILENAME)
+        self._conn: Optional[sqlite3.Connection] = None
+        # Analyses are cached from worker threads; serialize access to the connection
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database on first use"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(self.SCHEMA)
+        return self._conn
+
+    def _fetch(self, query: str, params: tuple) -> Optional[Union[str, int]]:
+        """Return the first column of the first matching row, or None on a miss"""
+        try:
+            with self._lock:
+                row = self._connect().execute(query, params).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️  {self.NAME} cache read failed: {e}")
+            return None
+        return row[0] if row else None
+
+    def _store(self, query: str, params: tuple) -> None:
+        """Run a write in its own transaction"""
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute(query, params)
+        except sqlite3.Error as e:
+            print(f"⚠️  {self.NAME} cache write failed: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JobLogCache(_SQLiteCache):
+    """SQLite store of job log tails that survives across workflow runs"""
+
+    NAME = "Log"
+    FILENAME = "job_logs.db"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS job_logs("
+        "job_id INTEGER PRIMARY KEY, completed_at TEXT, body TEXT)"
+    )
+
+    def get(self, job_id: int, completed_at: str) -> Optional[str]:
+        """Return cached logs for a job, or None on a miss"""
+        return self._fetch(
+            "SELECT body FROM job_logs WHERE job_id = ? AND completed_at = ?",
+            (job_id, completed_at),
+        )
+
+    def put(self, job_id: int, completed_at: str, body: str) -> None:
+        """Store logs for a completed job"""
+        self._store(
+            "INSERT OR REPLACE INTO job_logs VALUES (?, ?, ?)",
+            (job_id, completed_at, body),
+        )
+
+
+class AnalysisCache(_SQLiteCache):
+    """SQLite store of LLM analyses keyed by a hash of the request, with expiry"""
+
+    NAME = "Analysis"
+    FILENAME = "analyses.db"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS llm_cache("
+        "key TEXT PRIMARY KEY, created_at REAL, body TEXT)"
+    )
+
+    def __init__(self, cache_dir: str, ttl: float = ANALYSIS_TTL):
+        super().__init__(cache_dir)
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached analysis for a key, or None on a miss or once it expired"""
+        return self._fetch(
+            "SELECT body FROM llm_cache WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        )
+
+    def put(self, key: str, body: str) -> None:
+        """Store a successful analysis"""
+        self._store(
+            "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+            (key, time.time(), body),
+        )
+
+
+class CommentIdCache(_SQLiteCache):
+    """SQLite store of the summary comment id CI Rescue keeps on each pull request"""
+
+    NAME = "Comment"
+    FILENAME = "comments.db"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS comments("
+        "repo TEXT, pr INTEGER, comment_id INTEGER, PRIMARY KEY (repo, pr))"
+    )
+
+    def get(self, repo: str, pr_number: int) -> Optional[int]:
+        """Return the remembered comment id for a pull request, or None"""
+        return self._fetch(
+            "SELECT comment_id FROM comments WHERE repo = ? AND pr = ?",
+            (repo, pr_number),
+        )
+
+    def put(self, repo: str, pr_number: int, comment_id: int) -> None:
+        """Remember the comment id for a pull request"""
+        self._store(
+            "INSERT OR REPLACE INTO comments VALUES (?, ?, ?)",
+            (repo, pr_number, comment_id),
+        )
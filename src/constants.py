@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Shared constants for CI Rescue
+"""
+
+# GitHub REST endpoints, filled in with str.format
+JOBS_URL_T = "https://api.github.com/repos/{repo}/actions/runs/{run_id}/jobs"
+JOB_LOGS_URL_T = "https://api.github.com/repos/{repo}/actions/jobs/{job_id}/logs"
+COMMIT_PULLS_URL_T = "https://api.github.com/repos/{repo}/commits/{sha}/pulls"
+ISSUE_COMMENT_URL_T = "https://api.github.com/repos/{repo}/issues/comments/{comment_id}"
+REVIEW_COMMENTS_URL_T = "https://api.github.com/repos/{repo}/pulls/{number}/comments"
+REVIEW_COMMENT_URL_T = "https://api.github.com/repos/{repo}/pulls/comments/{comment_id}"
+
+# Hidden markers identifying comments posted by CI Rescue
+CI_RESCUE_COMMENT_MARKER = "<!-- CI-RESCUE-COMMENT -->"
+CI_ANNOTATION_MARKER = "<!-- CI-RESCUE-ANNOTATION -->"
+
+# Heading every analysis starts with, whether it comes from the model or the fallback
+CI_FAILURE_ANALYSIS_TITLE = "🚨 **CI Failure Analysis**"
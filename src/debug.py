@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+Opt-in verbose output for CI Rescue
+"""
+
+import os
+
+# Step-by-step tracing is only printed when the action's debug input is on
+DEBUG = os.getenv("INPUT_DEBUG", "false").lower() == "true"
+
+
+def debug(*args) -> None:
+    """Print only when debug output is enabled"""
+    if DEBUG:
+        print(*args)
@@ -3,78 +3,285 @@
 GitHub client utilities
 """
 
-import json
+import functools
 import os
+import re
+import time
 
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 from github import Github
 from github.PullRequest import PullRequest
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cache import CommentIdCache, JobLogCache
+from constants import (
+    CI_ANNOTATION_MARKER,
+    CI_RESCUE_COMMENT_MARKER,
+    COMMIT_PULLS_URL_T,
+    ISSUE_COMMENT_URL_T,
+    JOB_LOGS_URL_T,
+    JOBS_URL_T,
+    REVIEW_COMMENT_URL_T,
+    REVIEW_COMMENTS_URL_T,
+)
 from models import FailureInfo
 
+# (connect, read) timeouts for raw GitHub REST calls
+REQUEST_TIMEOUT = (5, 30)
+# Upper bounds on concurrent downloads and deletes; stay below the pool size
+LOG_FETCH_WORKERS = 8
+DELETE_WORKERS = 8
+# Only the end of a job log is kept; errors are almost always there
+LOG_TAIL_CHARS = 5000
+LOG_CHUNK_SIZE = 65536
+# Longest pause for an exhausted rate limit before letting the next call fail
+RATE_LIMIT_MAX_WAIT = 60
+# Methods safe to send again; creating a comment or review twice is not harmless
+RETRY_METHODS = frozenset({"GET", "DELETE"})
+# Statuses GitHub answers with once a rate limit is exhausted
+RATE_LIMITED_STATUSES = frozenset({403, 429})
+# Largest page the jobs endpoint allows; the default of 30 hides big matrices
+JOBS_PER_PAGE = 100
+# Job conclusions that count as a failure worth analyzing
+FAILED_JOB_CONCLUSIONS = frozenset({"failure", "cancelled", "timed_out"})
+# Prepended to every inline annotation body
+ANNOTATION_PREFIX = f"{CI_ANNOTATION_MARKER}\n"
+# "@@ -a,b +c,d @@" header of a unified diff hunk; captures c and d
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", re.M)
+
+
+def create_session(github_token: str) -> requests.Session:
+    """Create a pooled, retrying session authenticated against the GitHub API"""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"token {github_token}",
+        "Accept": "application/vnd.github.v3+json"
+    })
+    # A 403 is usually a real permission error; the response hook retries the
+    # ones that are GitHub's secondary rate limit instead
+    retry = Retry(
+        total=5,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=RETRY_METHODS,
+        # Once retries run out, hand back the last response so callers can
+        # check its status instead of catching a RetryError
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+    session.hooks["response"].append(wait_for_rate_limit)
+    return session
+
+
+def rate_limit_delay(response: requests.Response) -> Optional[float]:
+    """Seconds to wait out the rate limit a throttled response reports, or None if it reports none"""
+    if response.status_code not in RATE_LIMITED_STATUSES:
+        # A successful call that spent the last of the quota is not throttled yet
+        return None
+    if "Retry-After" in response.headers:
+        try:
+            return min(max(float(response.headers["Retry-After"]), 0), RATE_LIMIT_MAX_WAIT)
+        except ValueError:
+            pass
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            reset_at = int(response.headers.get("X-RateLimit-Reset", 0))
+        except ValueError:
+            return None
+        return min(max(reset_at - time.time(), 0), RATE_LIMIT_MAX_WAIT)
+    return None
+
+
+def wait_for_rate_limit(response: requests.Response, *args, **kwargs) -> requests.Response:
+    """Response hook that waits out an exhausted rate limit, retrying a throttled 403 once"""
+    delay = rate_limit_delay(response)
+    if delay is None:
+        return response
+    resend = response.status_code == 403 and response.request.method in RETRY_METHODS
+    if response.status_code == 403 and not resend:
+        # A write is never resent, so waiting before handing back its 403 gains nothing
+        return response
+    if delay:
+        print(f"⏳ GitHub rate limit exhausted, waiting {delay:.0f}s")
+        time.sleep(delay)
+    if resend:
+        # The resent response skips the hooks, so a limit that is still hit comes back as a 403
+        response.close()
+        return response.connection.send(response.request, **kwargs)
+    return response
+
+
+def read_log_tail(response: requests.Response, max_chars: int = LOG_TAIL_CHARS) -> str:
+    """Read a streamed response body, keeping only its last max_chars characters"""
+    # A UTF-8 character is at most 4 bytes, so this many trailing bytes always
+    # decode to at least max_chars characters
+    max_bytes = max_chars * 4
+    window = bytearray()
+    for chunk in response.iter_content(chunk_size=LOG_CHUNK_SIZE):
+        window += chunk
+        # Sliding window: trimming the front of a bytearray doesn't copy the rest
+        if len(window) > max_bytes:
+            del window[:-max_bytes]
+    return window.decode("utf-8", errors="replace")[-max_chars:]
+
+
+@functools.cache
+def load_event() -> dict:
+    """Load the payload of the event that triggered the workflow, once per process"""
+    event_path = os.getenv("GITHUB_EVENT_PATH")
+    if not event_path or not os.path.exists(event_path):
+        return {}
+    with open(event_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def fetch_jobs(repo: str, run_id: str, session: requests.Session) -> Tuple[int, Optional[dict]]:
+    """Fetch every page of a run's jobs; returns (status, payload)"""
+    url = f"{JOBS_URL_T.format(repo=repo, run_id=run_id)}?per_page={JOBS_PER_PAGE}"
+    payload = None
+    while url:
+        response = session.get(url, timeout=REQUEST_TIMEOUT)
+        try:
+            if response.status_code != 200:
+                return response.status_code, None
+            page = orjson.loads(response.content)
+            if payload is None:
+                payload = page
+            else:
+                payload["jobs"].extend(page.get("jobs", []))
+            url = response.links.get("next", {}).get("url")
+        finally:
+            response.close()
+    return 200, payload
+
 
 class GitHubClient:
-    def __init__(self, github_token: str, repository: str, run_id: str):
+    def __init__(self, github_token: str, repository: str, run_id: str, cache_dir: Optional[str] = None):
         self.github_token = github_token
         self.repository = repository
         self.run_id = run_id
-        self.github = Github(self.github_token)
+        # Fewer, larger pages when walking comments and pull requests
+        self.github = Github(self.github_token, per_page=100)
         self.event_name = os.getenv("GITHUB_EVENT_NAME")
         self.sha = os.getenv("GITHUB_SHA")
         self.comment_mode = os.getenv("INPUT_COMMENT_MODE", "update-existing")
+        self._session = create_session(self.github_token)
+        self._log_cache: Dict[int, str] = {}
+        # Logs of completed jobs never change, so they can be reused across runs
+        self._log_store = JobLogCache(cache_dir) if cache_dir else None
+        self._comment_id: Optional[int] = None
+        # Lets later runs edit their summary comment without scanning the PR
+        self._comment_store = CommentIdCache(cache_dir) if cache_dir else None
+
+    def close(self) -> None:
+        """Release pooled HTTP connections and the caches"""
+        self._session.close()
+        if self._log_store:
+            self._log_store.close()
+        if self._comment_store:
+            self._comment_store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def get_workflow_run_failures(self) -> List[FailureInfo]:
         """Get failure information from the current workflow run"""
-        failures = []
+        status, jobs_data = fetch_jobs(self.repository, self.run_id, self._session)
+        if status != 200:
+            print(f"Error getting jobs: {status}")
+            return []
+
+        # Flatten failed jobs into plain tuples; the rest of the payload is
+        # dropped right away instead of living as long as the client
+        failed_jobs = [
+            (job['id'], job.get('name', 'Unknown Job'), job.get('conclusion', 'Unknown'),
+             job.get('completed_at'), job.get('steps', ()))
+            for job in jobs_data.get('jobs', []) if job.get('conclusion') in FAILED_JOB_CONCLUSIONS
+        ]
+        del jobs_data
 
-        headers = {
-            "Authorization": f"token {self.github_token}",
-            "Accept": "application/vnd.github.v3+json"
+        # Flatten their failed steps too
+        failed_steps = [
+            (job_id, job_name, conclusion, step.get('name', 'Unknown Step'), step.get('conclusion', 'Unknown error'))
+            for job_id, job_name, conclusion, _, steps in failed_jobs
+            for step in steps if step.get('conclusion') == "failure"
+        ]
+        step_job_ids = {job_id for job_id, *_ in failed_steps}
+        completed_at = {
+            job_id: done for job_id, _, _, done, _ in failed_jobs if job_id in step_job_ids
         }
 
-        jobs_url = f"https://api.github.com/repos/{self.repository}/actions/runs/{self.run_id}/jobs"
-        response = requests.get(jobs_url, headers=headers)
+        logs_by_job = {}
+        if self._log_store:
+            for job_id, done in completed_at.items():
+                cached = self._log_store.get(job_id, done) if done else None
+                if cached is not None:
+                    logs_by_job[job_id] = cached
 
-        if response.status_code != 200:
-            print(f"Error getting jobs: {response.status_code}")
-            return failures
+        # Fetch each remaining failed job's logs once, concurrently
+        job_ids = [job_id for job_id in completed_at if job_id not in logs_by_job]
+        if len(job_ids) > 1:
+            with ThreadPoolExecutor(max_workers=min(LOG_FETCH_WORKERS, len(job_ids))) as executor:
+                logs_by_job.update(zip(job_ids, executor.map(self.get_job_logs, job_ids)))
+        else:
+            # Nothing to overlap; don't pay for spinning up a pool
+            logs_by_job.update((job_id, self.get_job_logs(job_id)) for job_id in job_ids)
 
-        jobs_data = response.json()
-        jobs = jobs_data.get('jobs', [])
-        
-        for job in jobs:
-            if job.get('conclusion') in ["failure", "cancelled", "timed_out"]:
-                error_steps = [step for step in job.get('steps', []) if step.get('conclusion') == "failure"]
-
-                for step in error_steps:
-                    logs = self.get_job_logs(job['id'])
-
-                    failures.append(FailureInfo(
-                        job_name=job.get('name', 'Unknown Job'),
-                        step_name=step.get('name', 'Unknown Step'),
-                        error_message=step.get('conclusion', 'Unknown error'),
-                        logs=logs,
-                        conclusion=job.get('conclusion', 'Unknown')
-                    ))
-        
-        return failures
+        if self._log_store:
+            for job_id in job_ids:
+                # Only successful downloads of finished jobs are worth keeping
+                if completed_at[job_id] and job_id in self._log_cache:
+                    self._log_store.put(job_id, completed_at[job_id], self._log_cache[job_id])
+
+        return [
+            FailureInfo(
+                job_name=job_name,
+                step_name=step_name,
+                error_message=step_conclusion,
+                logs=logs_by_job[job_id],
+                conclusion=conclusion
+            )
+            for job_id, job_name, conclusion, step_name, step_conclusion in failed_steps
+        ]
 
     def get_job_logs(self, job_id: int) -> str:
         """Get logs for a specific job"""
+        if job_id in self._log_cache:
+            return self._log_cache[job_id]
+
         try:
-            headers = {
-                "Authorization": f"token {self.github_token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
+            url = JOB_LOGS_URL_T.format(repo=self.repository, job_id=job_id)
+            # GitHub answers with a redirect to the log blob; resolve it ourselves
+            # so the tail can be requested from the blob store directly
+            with self._session.get(url, stream=True, allow_redirects=False, timeout=REQUEST_TIMEOUT) as response:
+                blob_url = response.headers.get("Location") if response.is_redirect else None
+                if not blob_url:
+                    if response.status_code != 200:
+                        return f"Could not retrieve logs (status: {response.status_code})"
+                    logs = read_log_tail(response)
 
-            url = f"https://api.github.com/repos/{self.repository}/actions/jobs/{job_id}/logs"
-            response = requests.get(url, headers=headers)
+            if blob_url:
+                # The blob URL is pre-signed and must not receive the GitHub token
+                headers = {"Authorization": None, "Range": f"bytes=-{LOG_TAIL_CHARS * 4}"}
+                with self._session.get(blob_url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT) as response:
+                    if response.status_code == 416:
+                        # No suffix range can be satisfied by an empty log
+                        logs = ""
+                    elif response.status_code not in (200, 206):
+                        return f"Could not retrieve logs (status: {response.status_code})"
+                    else:
+                        # A 200 means the range was ignored; the streamed tail still bounds memory
+                        logs = read_log_tail(response)
 
-            if response.status_code == 200:
-                logs = response.text
-                return logs[-5000:] if len(logs) > 5000 else logs
-            else:
-                return f"Could not retrieve logs (status: {response.status_code})"
+            self._log_cache[job_id] = logs
+            return logs
 
         except Exception as e:
             return f"Error retrieving logs: {str(e)}"
@@ -82,23 +289,24 @@ class GitHubClient:
     def get_pull_request(self) -> Optional[PullRequest]:
         """Get the pull request associated with this run"""
         try:
-            repo = self.github.get_repo(self.repository)
+            repo = self.github.get_repo(self.repository, lazy=True)
             
             # For pull_request events, get PR from event
             if self.event_name == "pull_request":
-                event_path = os.getenv("GITHUB_EVENT_PATH")
-                if event_path and os.path.exists(event_path):
-                    with open(event_path, 'r') as f:
-                        event_data = json.load(f)
-                    pr_number = event_data.get("pull_request", {}).get("number")
-                    if pr_number:
-                        return repo.get_pull(pr_number)
+                pr_number = load_event().get("pull_request", {}).get("number")
+                if pr_number:
+                    return repo.get_pull(pr_number)
             
-            # For other events, search for PRs with this commit
-            prs = repo.get_pulls(state="open")
-            for pr in prs:
-                if pr.head.sha == self.sha:
-                    return pr
+            # For other events, ask GitHub which PRs this commit belongs to
+            url = COMMIT_PULLS_URL_T.format(repo=self.repository, sha=self.sha)
+            response = self._session.get(url, timeout=REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                print(f"Error getting pull requests for {self.sha}: {response.status_code}")
+                return None
+
+            for pr_data in orjson.loads(response.content):
+                if pr_data.get("state") == "open" and pr_data.get("head", {}).get("sha") == self.sha:
+                    return repo.get_pull(pr_data["number"])
                     
             return None
             
@@ -108,26 +316,54 @@ class GitHubClient:
 
     def post_or_update_comment(self, pr: PullRequest, analysis: str) -> None:
         """Post or update a comment on the pull request"""
-        comment_marker = "<!-- CI-RESCUE-COMMENT -->"
-        comment_body = f"{comment_marker}\n{analysis}"
+        comment_body = f"{CI_RESCUE_COMMENT_MARKER}\n{analysis}"
         
         try:
             if self.comment_mode == "update-existing":
-                # Look for existing comment
-                comments = pr.get_issue_comments()
-                for comment in comments:
-                    if comment_marker in comment.body:
+                # Reuse the comment found or created earlier in this run, or in
+                # an earlier run when the comment id cache is enabled
+                comment_id = self._comment_id
+                if comment_id is None and self._comment_store:
+                    comment_id = self._comment_store.get(self.repository, pr.number)
+                if comment_id is not None and self._edit_comment(comment_id, comment_body):
+                    self._remember_comment(pr, comment_id)
+                    print(f"Updated existing comment on PR #{pr.number}")
+                    return
+
+                # Look for existing comment; pages are fetched lazily, so stop at the first match
+                for comment in pr.get_issue_comments():
+                    if CI_RESCUE_COMMENT_MARKER in (comment.body or ""):
                         comment.edit(comment_body)
+                        self._remember_comment(pr, comment.id)
                         print(f"Updated existing comment on PR #{pr.number}")
                         return
             
             # Create new comment if no existing one found or mode is create-new
-            pr.create_issue_comment(comment_body)
+            comment = pr.create_issue_comment(comment_body)
+            if self.comment_mode == "update-existing":
+                self._remember_comment(pr, comment.id)
             print(f"Created new comment on PR #{pr.number}")
             
         except Exception as e:
             print(f"Error posting comment: {e}")
 
+    def _edit_comment(self, comment_id: int, body: str) -> bool:
+        """Edit an issue comment by id in a single PATCH; False if it is gone or the edit fails"""
+        url = ISSUE_COMMENT_URL_T.format(repo=self.repository, comment_id=comment_id)
+        try:
+            response = self._session.patch(url, data=orjson.dumps({"body": body}), timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            # Let the caller fall back to scanning for the comment, as on a 404
+            print(f"⚠️  Failed to edit comment {comment_id}: {e}")
+            return False
+        return response.status_code == 200
+
+    def _remember_comment(self, pr: PullRequest, comment_id: int) -> None:
+        """Keep the summary comment id for the rest of this run and, if cached, later runs"""
+        if comment_id != self._comment_id and self._comment_store:
+            self._comment_store.put(self.repository, pr.number, comment_id)
+        self._comment_id = comment_id
+
     def post_line_annotations(self, pr, review_comments):
         """Post line annotations on the pull request"""
         if not review_comments:
@@ -142,28 +378,102 @@ class GitHubClient:
             if not isinstance(comment['line'], int):
                 raise ValueError(f"Review comment {i} 'line' must be an integer")
         
+        # Resolve the head commit with a single GET; every comment is anchored to it
+        try:
+            head_commit = pr.base.repo.get_commit(pr.head.sha)
+        except Exception as e:
+            print(f"❌ Failed to resolve head commit {pr.head.sha}: {e}")
+            return
+
+        # Inline comments are only accepted on lines inside the diff; decide
+        # locally instead of letting GitHub reject the whole review
+        try:
+            diff_lines = self._build_diff_linemap(pr)
+        except Exception as e:
+            print(f"❌ Failed to list changed files: {e}")
+            return
+
+        in_diff = [
+            dict(c, body=ANNOTATION_PREFIX + c['body'])
+            for c in review_comments if c['line'] in diff_lines.get(c['path'], ())
+        ]
+        skipped = len(review_comments) - len(in_diff)
+        if skipped:
+            print(f"⚠️  Skipping {skipped} annotation(s) outside the PR diff (kept in the summary comment)")
+        if not in_diff:
+            return
+
+        # List earlier annotations now, but only delete them once the new
+        # review is in place; a failed run must not leave the PR with none
+        previous = self._list_ci_rescue_annotations(pr) if self.comment_mode == "update-existing" else None
+
         # Create a review with the comments
         try:
             review = pr.create_review(
-                commit=pr.get_commits().reversed[0],  # Latest commit
+                commit=head_commit,
                 event='COMMENT',
-                comments=review_comments
+                comments=in_diff
             )
-            print(f"✅ Posted {len(review_comments)} line annotations as review #{review.id}")
-            
+            print(f"✅ Posted {len(in_diff)} line annotations as review #{review.id}")
         except Exception as e:
             print(f"❌ Failed to create review with line comments: {e}")
-            print("🔄 Falling back to individual comments...")
-            
-            # Fallback: Post individual comments
-            for comment_data in review_comments:
-                try:
-                    pr.create_review_comment(
-                        body=comment_data['body'],
-                        commit=pr.get_commits().reversed[0],
-                        path=comment_data['path'],
-                        line=comment_data['line']
-                    )
-                    print(f"   ✅ Posted comment on {comment_data['path']}:{comment_data['line']}")
-                except Exception as comment_error:
-                    print(f"   ❌ Failed to post comment on {comment_data['path']}:{comment_data['line']}: {comment_error}")
+            return
+
+        if previous:
+            self._delete_annotations(previous)
+
+    def _list_ci_rescue_annotations(self, pr) -> Optional[List[int]]:
+        """Ids of the CI Rescue inline annotations on the pull request, or None if listing fails"""
+        # Page through the raw JSON so no comment gets hydrated into a PyGithub object
+        ci_rescue_comments = []
+        url = f"{REVIEW_COMMENTS_URL_T.format(repo=self.repository, number=pr.number)}?per_page=100"
+        try:
+            while url:
+                response = self._session.get(url, timeout=REQUEST_TIMEOUT)
+                if response.status_code != 200:
+                    print(f"❌ Failed to list previous annotations: {response.status_code}")
+                    return None
+                ci_rescue_comments.extend(
+                    comment['id'] for comment in orjson.loads(response.content)
+                    if CI_ANNOTATION_MARKER in (comment.get('body') or "")
+                )
+                url = response.links.get('next', {}).get('url')
+        except Exception as e:
+            print(f"❌ Failed to list previous annotations: {e}")
+            return None
+        return ci_rescue_comments
+
+    def _delete_annotations(self, ci_rescue_comments: List[int]) -> None:
+        """Delete review comments by id"""
+        # Each delete is an independent round-trip, so issue them concurrently
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+            deleted = sum(executor.map(self._safe_delete, ci_rescue_comments))
+        print(f"🧹 Removed {deleted}/{len(ci_rescue_comments)} previous CI Rescue annotations")
+
+    def _safe_delete(self, comment_id: int) -> bool:
+        """Delete a review comment, reporting instead of raising on failure"""
+        url = REVIEW_COMMENT_URL_T.format(repo=self.repository, comment_id=comment_id)
+        try:
+            response = self._session.delete(url, timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            print(f"   ❌ Failed to delete annotation {comment_id}: {e}")
+            return False
+        if response.status_code != 204:
+            print(f"   ❌ Failed to delete annotation {comment_id}: {response.status_code}")
+            return False
+        return True
+
+    def _build_diff_linemap(self, pr) -> Dict[str, Set[int]]:
+        """Map each changed file to the right-side line numbers covered by its diff hunks"""
+        linemap = {}
+        for changed_file in pr.get_files():
+            # Binary files and very large diffs come without a patch
+            if not changed_file.patch:
+                continue
+            lines = set()
+            for match in HUNK_HEADER_RE.finditer(changed_file.patch):
+                start = int(match.group(1))
+                count = int(match.group(2)) if match.group(2) is not None else 1
+                lines.update(range(start, start + count))
+            linemap[changed_file.filename] = lines
+        return linemap
@@ -5,32 +5,52 @@ CI Rescue - AI-Powered GitHub Action for CI Failure Analysis
 
 import os
 import sys
-import json
-from typing import List, Optional
-from github_client import GitHubClient
-from openrouter_client import OpenRouterClient
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from annotations import failure_summary, parse_analysis, render_annotations
 from models import FailureInfo
 
+# Inputs and GitHub context the action cannot run without
+REQUIRED_ENV_VARS = ("INPUT_GITHUB_TOKEN", "INPUT_OPENROUTER_API_KEY", "GITHUB_REPOSITORY", "GITHUB_RUN_ID")
+
 
 class CIRescue:
     """Main class for CI Rescue functionality"""
 
     def __init__(self):
-        self.github_token = os.getenv("INPUT_GITHUB_TOKEN")
-        self.openrouter_api_key = os.getenv("INPUT_OPENROUTER_API_KEY")
-        self.model = os.getenv("INPUT_MODEL", "openai/gpt-4o-mini")
-        self.max_tokens = int(os.getenv("INPUT_MAX_TOKENS", "1000"))
+        env = os.environ
+        # Fail fast, before any client or HTTP session is built
+        missing = [name for name in REQUIRED_ENV_VARS if not env.get(name)]
+        if missing:
+            raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+
+        self.github_token = env["INPUT_GITHUB_TOKEN"]
+        self.openrouter_api_key = env["INPUT_OPENROUTER_API_KEY"]
+        self.model = env.get("INPUT_MODEL", "openai/gpt-4o-mini")
+        self.max_tokens = int(env.get("INPUT_MAX_TOKENS", "1000"))
+        self.max_concurrent = int(env.get("INPUT_MAX_CONCURRENT", "5"))
+        if self.max_concurrent < 1:
+            raise ValueError(f"INPUT_MAX_CONCURRENT must be at least 1, got {self.max_concurrent}")
+        self.requests_per_minute = int(env.get("INPUT_REQUESTS_PER_MINUTE", "0"))
+        # Opt-in directory for caches that persist across workflow runs
+        self.cache_dir = env.get("CI_RESCUE_CACHE_DIR") or None
 
         # GitHub context
-        self.repository = os.getenv("GITHUB_REPOSITORY")
-        self.run_id = os.getenv("GITHUB_RUN_ID")
-
-        # Initialize clients
-        self.github = GitHubClient(self.github_token, self.repository, self.run_id)
-        self.openrouter = OpenRouterClient(self.openrouter_api_key, self.model)
-
-        if not all([self.github_token, self.openrouter_api_key, self.repository, self.run_id]):
-            raise ValueError("Missing required environment variables")
+        self.repository = env["GITHUB_REPOSITORY"]
+        self.run_id = env["GITHUB_RUN_ID"]
+
+        # Initialize clients; imported here so a misconfigured run never loads PyGithub
+        from github_client import GitHubClient
+        from openrouter_client import OpenRouterClient
+
+        self.github = GitHubClient(
+            self.github_token, self.repository, self.run_id,
+            cache_dir=self.cache_dir,
+        )
+        self.openrouter = OpenRouterClient(
+            self.openrouter_api_key, self.model, self.max_concurrent,
+            cache_dir=self.cache_dir, requests_per_minute=self.requests_per_minute,
+        )
 
     def run(self) -> None:
         """Main execution method"""
@@ -42,7 +62,7 @@ class CIRescue:
             return
 
         print(f"🚨 Found {len(failures)} failure(s)")
-
+        # Only looked up once there is something to report; green runs skip the call
         pr = self.github.get_pull_request()
         if not pr:
             print("ℹ️  No pull request found for this run - skipping comment")
@@ -50,150 +70,59 @@ class CIRescue:
 
         print(f"📝 Found PR #{pr.number}: {pr.title}")
 
-        primary_failure = failures[0]
-        print(f"🤖 Analyzing failure in job '{primary_failure.job_name}'...")
+        # Later failed steps of a job usually fail because of the first one,
+        # so only the first is analyzed and the rest are just listed
+        first_by_job = {}
+        for failure in failures:
+            first_by_job.setdefault(failure.job_name, failure)
+        later_steps = [f for f in failures if f is not first_by_job[f.job_name]]
 
-        analysis_text = self.openrouter.analyze_failure(primary_failure, self.max_tokens)
-        comment, annotations = self._parse_analysis_with_annotations(analysis_text)
+        analysis, annotations = self._analyze_failures(list(first_by_job.values()))
+        comment_parts = [analysis]
+        review_comments = []
 
         if annotations:
             print(f"📌 Adding {len(annotations)} annotations to PR comment summary")
-            annotation_comments = self.format_annotations_for_comment(annotations)
-            comment += annotation_comments
+            annotations_md, review_comments = render_annotations(annotations)
+            comment_parts.append(annotations_md)
         else:
             print("ℹ️  No annotations to add to PR comment")
 
-        if len(failures) > 1:
-            comment += self._create_failure_summary(failures)
+        if later_steps:
+            comment_parts.append(failure_summary(later_steps))
 
-        self.github.post_or_update_comment(pr, comment)
-        if annotations:
-            review_comments = self.convert_annotations_to_review_comments(annotations)
+        self.github.post_or_update_comment(pr, "".join(comment_parts))
+        if review_comments:
             self.github.post_line_annotations(pr, review_comments)
 
         print("✅ Analysis complete!")
 
-    def _parse_analysis_with_annotations(self, analysis_text: str) -> (str, Optional[List[dict]]):
-        """Parse the AI response to separate the comment from annotations."""
-        marker = "<<<CI-RESCUE-ANNOTATIONS>>>"
-        print(f"🔍 Parsing AI response for annotations (length: {len(analysis_text)} chars)...")
-
-        if marker in analysis_text:
-            print("📍 Found annotation marker in AI response")
-            parts = analysis_text.split(marker)
-            comment = parts[0]
+    def _analyze_failures(self, primaries: List[FailureInfo]) -> (str, List[dict]):
+        """Analyze one failed step per job concurrently"""
+        print(f"🤖 Analyzing {len(primaries)} failed job(s): {', '.join(f.job_name for f in primaries)}")
 
-            try:
-                annotations_json_str = parts[1]
-                print(f"📋 Raw annotation JSON: {annotations_json_str[:200]}..." if len(annotations_json_str) > 200 else f"📋 Raw annotation JSON: {annotations_json_str}")
+        # Each analysis is one blocking LLM round-trip; run them side by side
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent, len(primaries))) as executor:
+            analyses = list(executor.map(
+                lambda failure: self.openrouter.analyze_failure(failure, self.max_tokens),
+                primaries,
+            ))
 
-                annotations_data = json.loads(annotations_json_str)
-                annotations = annotations_data.get("annotations")
-
-                if annotations:
-                    print(f"✅ Successfully parsed {len(annotations)} annotation(s)")
-                    for i, annotation in enumerate(annotations):
-                        print(f"   📌 Annotation {i+1}: {annotation.get('path', 'unknown')}:{annotation.get('start_line', 'unknown')} - {annotation.get('message', 'no message')[:50]}...")
-                else:
-                    print("⚠️  No annotations found in parsed JSON")
-
-                return comment.strip(), annotations
-
-            except (json.JSONDecodeError, IndexError, AttributeError) as e:
-                print(f"❌ Failed to parse annotation JSON: {e}")
-                print(f"   Raw content: {parts[1][:100] if len(parts) > 1 else 'no content'}...")
-                return analysis_text.replace(marker, ""), None
-        else:
-            print("ℹ️  No annotation markers found in AI response")
-
-        return analysis_text, None
-
-    def convert_annotations_to_review_comments(self, annotations):
-        """Convert AI annotations to GitHub ReviewComment format"""
-        review_comments = []
-        
-        for annotation in annotations:
-            path = annotation.get('path', '')
-            if not path:
-                print(f"⚠️  Skipping annotation without path: {annotation}")
-                continue
-                
-            try:
-                line = int(annotation.get('start_line', annotation.get('line', 1)))
-            except (ValueError, TypeError):
-                print(f"⚠️  Invalid line number in annotation: {annotation}")
-                continue
-                
-            message = annotation.get('message', 'No message provided')
-            level = annotation.get('annotation_level', 'notice')
-            
-            # Create emoji based on level  
-            level_emoji = {
-                'failure': '❌',
-                'error': '🚨', 
-                'warning': '⚠️',
-                'notice': 'ℹ️'
-            }.get(level, '📝')
-            
-            review_comment = {
-                'path': path,
-                'line': line,
-                'body': f"{level_emoji} **CI Rescue Analysis**\n\n{message}"
-            }
-            
-            review_comments.append(review_comment)
-            
-        print(f"🔍 Converted {len(annotations)} annotations to {len(review_comments)} review comments")
-        return review_comments
-
-    def format_annotations_for_comment(self, annotations: List[dict]) -> str:
-        """Format annotations as markdown for inclusion in PR comment."""
-        if not annotations:
-            return ""
-
-        print(f"📝 Formatting {len(annotations)} annotations for PR comment")
-
-        formatted = "\n\n## 📍 **Code Annotations**\n\n"
-
-        for annotation in annotations:
-            path = annotation.get('path', 'unknown file')
-            start_line = annotation.get('start_line', annotation.get('line', 'unknown'))
-            end_line = annotation.get('end_line', start_line)
-            message = annotation.get('message', 'No message provided')
-            level = annotation.get('annotation_level', 'notice')
-
-            # Choose emoji based on annotation level
-            level_emoji = {
-                'failure': '❌',
-                'error': '🚨', 
-                'warning': '⚠️',
-                'notice': 'ℹ️'
-            }.get(level, '📝')
-
-            if start_line == end_line:
-                line_info = f"Line {start_line}"
-            else:
-                line_info = f"Lines {start_line}-{end_line}"
-
-            formatted += f"{level_emoji} **{path}** ({line_info})\n"
-            formatted += f"   {message}\n\n"
-
-        return formatted
-
-    def _create_failure_summary(self, failures: List[FailureInfo]) -> str:
-        """Create summary for additional failures"""
-        other_failures = "\n".join([
-            f"- **{f.job_name}** → {f.step_name} ({f.conclusion})"
-            for f in failures[1:]
-        ])
-        return f"\n\n**Additional Failures:**\n{other_failures}"
+        comments = []
+        annotations = []
+        for analysis_text in analyses:
+            comment, parsed = parse_analysis(analysis_text)
+            comments.append(comment)
+            annotations.extend(parsed or [])
+        return "\n\n---\n\n".join(comments), annotations
 
 
 def main():
     """Entry point"""
     try:
         rescue = CIRescue()
-        rescue.run()
+        with rescue.github, rescue.openrouter:
+            rescue.run()
     except Exception as e:
         print(f"❌ CI Rescue failed: {e}")
         sys.exit(1)
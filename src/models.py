@@ -6,7 +6,7 @@ Data models for CI Rescue
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class FailureInfo:
     """Container for CI failure information"""
     job_name: str
@@ -3,44 +3,57 @@
 OpenRouter Client for analyzing CI failures
 """
 
+import functools
+import hashlib
+import random
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Optional
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from cache import AnalysisCache
+from constants import CI_FAILURE_ANALYSIS_TITLE
 from models import FailureInfo
 
-class OpenRouterClient:
-    """Client for interacting with OpenRouter API"""
-
-    def __init__(self, api_key: str, model: str = "openai/gpt-4o-mini"):
-        self.api_key = api_key
-        self.model = model
-        self.base_url = "https://openrouter.ai/api/v1"
-
-    def analyze_failure(self, failure_info: FailureInfo, max_tokens: int = 1000) -> str:
-        """Analyze CI failure and provide suggestions"""
-        print(f"🔍 Failure info: {failure_info}")
-        error_context = self._extract_error_context(failure_info.logs)
-        print(f"🔍 Analyzing failure in job '{failure_info.logs}'...")
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503)
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 60
+# Raw log output quoted in the prompt, on top of the extracted error context
+PROMPT_LOG_TAIL_CHARS = 1500
+# Most of a log scanned for error context; callers that bypass the GitHub
+# client's tailing may hand over whole multi-MB logs
+MAX_SCAN_LOG_CHARS = 256 * 1024
+# Lines quoted on each side of an error line, how many error contexts reach
+# the prompt (the last ones in the log) and what separates them
+CONTEXT_LINES = 5
+MAX_CONTEXT_BLOCKS = 3
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+# Run-specific noise masked out of the cache key so reruns of the same failure
+# hit: log timestamps, commit/object hashes and test durations
+VOLATILE_RE = re.compile(
+    r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z?|\b[0-9a-f]{12,40}\b|\b\d+\.\d+s\b"
+)
 
-        prompt = self._create_prompt(failure_info, error_context)
-        headers = self._create_headers()
-        data = self._create_data(prompt, max_tokens)
-
-        return self._post_analysis_request(headers, data)
-
-    def _create_prompt(self, failure_info: FailureInfo, error_context: str) -> str:
-        """Create prompt for the AI model"""
-        return f"""
+PROMPT_TEMPLATE = """
 You are an expert CI/CD assistant. Analyze this GitHub Actions workflow failure and provide a concise, actionable comment for the pull request.
 
-- Job: {failure_info.job_name}
-- Step: {failure_info.step_name}
-- Status: {failure_info.conclusion}
+- Job: {job}
+- Step: {step}
+- Status: {conclusion}
 
 **Error Details:**
 {error_context}
 
 **Recent Log Output:**
 ```
-{failure_info.logs[-1500:]}
+{log_tail}
 ```
 
 Please provide:
@@ -53,7 +66,7 @@ Be specific about:
 - Exact error messages and their meaning
 - Command-line fixes when possible
 
-Format as a helpful GitHub comment in markdown. Start with "🚨 **CI Failure Analysis**".
+Format as a helpful GitHub comment in markdown. Start with "{title}".
 
 If the failure is related to specific files, provide annotations in a JSON block:
 <<<CI-RESCUE-ANNOTATIONS>>>
@@ -71,8 +84,104 @@ If the failure is related to specific files, provide annotations in a JSON block
 <<<CI-RESCUE-ANNOTATIONS>>>
 """
 
+
+def _distinct_needles(needles: list) -> tuple:
+    """Lowercase needles, dropping duplicates and those that contain a shorter one"""
+    folded = dict.fromkeys(n.lower() for n in needles)
+    return tuple(n for n in folded if not any(other != n and other in n for other in folded))
+
+
+class OpenRouterClient:
+    """Client for interacting with OpenRouter API"""
+
+    # Substrings that mark a log line as part of an error, matched case-insensitively
+    ERROR_INDICATORS = [
+        "ERROR", "FAILED", "Error:", "error:", "Exception:", "Traceback",
+        "TabError:", "SyntaxError:", "ImportError:", "ModuleNotFoundError:",
+        "AssertionError:", "##[error]", "FAIL:", "FAILURE:", "Remove unused import:"
+    ]
+    # "Error:", "SyntaxError:", "##[error]" and friends all contain "ERROR"
+    # once case is ignored, so only the needles that can match on their own
+    # are searched for
+    _ERROR_NEEDLES = _distinct_needles(ERROR_INDICATORS)
+    _ERROR_RE = re.compile("|".join(map(re.escape, _ERROR_NEEDLES)), re.IGNORECASE)
+
+    def __init__(self, api_key: str, model: str = "openai/gpt-4o-mini", max_concurrent: int = 5,
+                 cache_dir: Optional[str] = None, requests_per_minute: int = 0):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = "https://openrouter.ai/api/v1"
+        # Caps requests in flight no matter how many threads call in
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        # Spaces request starts evenly to stay under the account's RPM limit; 0 disables it
+        self._interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_start = 0.0
+        self._pace_lock = threading.Lock()
+        # Keep-alive pool shared by concurrent analyses; retries are handled
+        # in _post_analysis_request so urllib3 must not retry on its own
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0))
+        self._session.headers.update(self._create_headers())
+        # Payload fields that never change between analyses
+        self._base_data = {"model": self.model, "temperature": 0.1}
+        # The same failure analyzed again in a later run gets the same answer
+        self._cache = AnalysisCache(cache_dir) if cache_dir else None
+
+    def close(self) -> None:
+        """Release pooled HTTP connections and the analysis cache"""
+        self._session.close()
+        if self._cache:
+            self._cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def analyze_failure(self, failure_info: FailureInfo, max_tokens: int = 1000, no_cache: bool = False) -> str:
+        """Analyze CI failure and provide suggestions; no_cache forces a fresh request"""
+        error_context = self._extract_error_context(failure_info.logs)
+
+        prompt = self._create_prompt(failure_info, error_context)
+        key = self._cache_key(prompt, max_tokens)
+        if self._cache and not no_cache:
+            cached = self._cache.get(key)
+            if cached is not None:
+                print(f"♻️  Analysis cache hit for job '{failure_info.job_name}'", file=sys.stderr)
+                return cached
+            print(f"Analysis cache miss for job '{failure_info.job_name}'", file=sys.stderr)
+
+        data = self._create_data(prompt, max_tokens)
+
+        try:
+            analysis = self._post_analysis_request(data)
+        except Exception as e:
+            return f"{CI_FAILURE_ANALYSIS_TITLE}\n\n❌ Failed to analyze the error with AI: {str(e)}\n\n**Manual Review Needed:**\nPlease check the logs for more details."
+
+        # Only real answers are cached; a fallback message must not stick
+        if self._cache:
+            self._cache.put(key, analysis)
+        return analysis
+
+    def _cache_key(self, prompt: str, max_tokens: int) -> str:
+        """Digest of the request with run-specific noise masked out of the prompt"""
+        normalized = VOLATILE_RE.sub("#", prompt)
+        return hashlib.sha256(f"{self.model}|{max_tokens}|{normalized}".encode()).hexdigest()
+
+    def _create_prompt(self, failure_info: FailureInfo, error_context: str) -> str:
+        """Create prompt for the AI model"""
+        return PROMPT_TEMPLATE.format_map({
+            "title": CI_FAILURE_ANALYSIS_TITLE,
+            "job": failure_info.job_name,
+            "step": failure_info.step_name,
+            "conclusion": failure_info.conclusion,
+            "error_context": error_context,
+            "log_tail": failure_info.logs[-PROMPT_LOG_TAIL_CHARS:],
+        })
+
     def _create_headers(self) -> dict:
-        """Create headers for the HTTP request"""
+        """Create the headers every request carries, set once on the session"""
         return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -83,87 +192,114 @@ If the failure is related to specific files, provide annotations in a JSON block
     def _create_data(self, prompt: str, max_tokens: int) -> dict:
         """Create data payload for the HTTP request"""
         return {
-            "model": self.model,
+            **self._base_data,
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": max_tokens,
-            "temperature": 0.1
         }
 
-    def _post_analysis_request(self, headers: dict, data: dict) -> str:
-        """Post the analysis request to the AI model"""
+    def _post_analysis_request(self, data: dict) -> str:
+        """Post the analysis request to the AI model, raising if no analysis comes back"""
+        body = orjson.dumps(data)
+        for attempt in range(MAX_ATTEMPTS):
+            self._wait_for_rate_slot()
+            with self._slots:
+                response = self._session.post(
+                    url=f"{self.base_url}/chat/completions",
+                    data=body,
+                    timeout=60
+                )
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+                break
+            delay = self._retry_delay(response, attempt)
+            print(f"⏳ OpenRouter returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        return result["choices"][0]["message"]["content"]
+
+    def _wait_for_rate_slot(self) -> None:
+        """Block until this thread may start its next request under the RPM limit"""
+        if not self._interval:
+            return
+        with self._pace_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    @staticmethod
+    def _retry_delay(response: requests.Response, attempt: int) -> float:
+        """Seconds to wait before the next attempt, preferring the server's Retry-After"""
         try:
-            response = requests.post(
-                url=f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=60
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"🚨 **CI Failure Analysis**\n\n❌ Failed to analyze the error with AI: {str(e)}\n\n**Manual Review Needed:**\nPlease check the logs for more details."
+            return min(MAX_BACKOFF, float(response.headers["Retry-After"]))
+        except (KeyError, TypeError, ValueError):
+            return min(MAX_BACKOFF, 2 ** attempt) + random.random()
 
-    def _extract_error_context(self, logs: str) -> str:
+    # Retries and no-cache reruns scan the same log again; keyed on the log itself
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _extract_error_context(logs: str) -> str:
         """Extract key error information from logs with surrounding context"""
         if not logs:
             return "No logs available"
+        if len(logs) > MAX_SCAN_LOG_CHARS:
+            # Errors worth quoting sit near the end; start on a whole line
+            logs = logs[-MAX_SCAN_LOG_CHARS:]
+            logs = logs[logs.find('\n') + 1:]
 
-        error_indicators = [
-            "ERROR", "FAILED", "Error:", "error:", "Exception:", "Traceback",
-            "TabError:", "SyntaxError:", "ImportError:", "ModuleNotFoundError:",
-            "AssertionError:", "##[error]", "FAIL:", "FAILURE:", "Remove unused import:"
-        ]
-
-        lines = logs.split('\n')
-        error_line_indices = []
+        # A plain find() per needle over one lowercased copy is far cheaper
+        # than a case-insensitive regex, but only while lowercasing keeps
+        # every offset in place
+        lowered = logs.lower()
+        if len(lowered) == len(logs):
+            hits = []
+            for needle in OpenRouterClient._ERROR_NEEDLES:
+                pos = lowered.find(needle)
+                while pos != -1:
+                    hits.append(pos)
+                    pos = lowered.find(needle, pos + 1)
+            hits.sort()
+        else:
+            hits = [m.start() for m in OpenRouterClient._ERROR_RE.finditer(logs)]
 
-        # Find all lines with error indicators (case-insensitive)
-        for i, line in enumerate(lines):
-            if any(indicator.lower() in line.lower() for indicator in error_indicators):
-                error_line_indices.append(i)
+        if not hits:
+            # Fallback to last few lines of logs; no line table needed for that
+            tail = logs.rsplit('\n', 10)[-10:]
+            return "\n".join([line.strip() for line in tail if line.strip()])
 
-        if not error_line_indices:
-            # Fallback to last few lines of logs
-            return "\n".join([line.strip() for line in lines[-10:] if line.strip()])
+        # Each hit offset maps to its line through the offsets of the newlines
+        # before it. Lines are sliced out of the log on demand instead of
+        # splitting all of it
+        newlines = [m.start() for m in re.finditer('\n', logs)]
+        line_count = len(newlines) + 1
 
-        # Create context ranges (5 lines before and after each error)
-        context_ranges = []
-        for error_idx in error_line_indices:
-            start = max(0, error_idx - 5)
-            end = min(len(lines), error_idx + 6)  # +6 because range is exclusive
-            context_ranges.append((start, end, error_idx))
-        print(f"🔍 Context ranges: {context_ranges}")
-
-        # Merge overlapping ranges
-        merged_ranges = []
-        if not context_ranges:
-            return
+        def line_start(idx: int) -> int:
+            return newlines[idx - 1] + 1 if idx else 0
 
-        current_start, current_end, _ = sorted(context_ranges)[0]
+        # Hits are in log order, so line numbers only need deduplicating
+        error_line_indices = []
+        for hit in hits:
+            idx = bisect_left(newlines, hit)
+            if not error_line_indices or error_line_indices[-1] != idx:
+                error_line_indices.append(idx)
 
-        for next_start, next_end, error_idx in sorted(context_ranges)[1:]:
-            if next_start < current_end:  # Merge only if truly overlapping, not adjacent
-                current_end = max(current_end, next_end)
+        # Sweep the context ranges (CONTEXT_LINES before and after each error)
+        # in order; line numbers are ascending, so are the range starts. Only
+        # the last MAX_CONTEXT_BLOCKS are kept, to avoid overwhelming the AI
+        merged_ranges = deque(maxlen=MAX_CONTEXT_BLOCKS)
+        for error_idx in error_line_indices:
+            start = max(0, error_idx - CONTEXT_LINES)
+            end = min(line_count, error_idx + CONTEXT_LINES + 1)  # +1 because range is exclusive
+            # Merge only if truly overlapping, not adjacent; ends ascend too
+            if merged_ranges and start < merged_ranges[-1][1]:
+                merged_ranges[-1][1] = end
             else:
-                merged_ranges.append((current_start, current_end, error_idx))
-                current_start, current_end = next_start, next_end
+                merged_ranges.append([start, end])
 
-        merged_ranges.append((current_start, current_end, error_idx))
-
-        # Extract context blocks
         context_blocks = []
-        for start, end, error_idx in merged_ranges:
-            block_lines = []
-            for i in range(start, end):
-                if i < len(lines):
-                    block_lines.append(lines[i].rstrip())
-
-            if block_lines:
-                context_blocks.append("\n".join(block_lines))
-
-        # Limit output to avoid overwhelming the AI (max 3 context blocks)
-        if len(context_blocks) > 3:
-            context_blocks = context_blocks[-3:]  # Take the last 3 error contexts
+        for start, end in merged_ranges:
+            block = logs[line_start(start):newlines[end - 1] if end < line_count else len(logs)]
+            context_blocks.append("\n".join(line.rstrip() for line in block.split('\n')))
 
-        return "\n\n---\n\n".join(context_blocks)
+        return CONTEXT_SEPARATOR.join(context_blocks)
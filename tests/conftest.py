@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""
+Shared pytest setup for CI Rescue tests
+"""
+
+import os
+import sys
+
+# Add src to path for imports, once for the whole session
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -4,101 +4,362 @@ Tests for GitHub client functionality
 """
 
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 from typing import List
 import os
-import sys
+import tempfile
+from types import MappingProxyType, SimpleNamespace
 
-# Add src to path for imports
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import orjson
+import requests
+import responses
+from github.PullRequest import PullRequest
+
+from constants import CI_ANNOTATION_MARKER, CI_RESCUE_COMMENT_MARKER, JOB_LOGS_URL_T, JOBS_URL_T
+from github_client import GitHubClient, create_session, load_event, wait_for_rate_limit
+
+# Jobs listing as returned by the GitHub REST API, trimmed to the fields used
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "workflow_run_jobs.json"), "rb") as f:
+    WORKFLOW_RUN_JOBS = f.read()
+
+# Mock environment variables, read-only so no test can leak changes into another
+ENV_VARS = MappingProxyType({
+    "INPUT_GITHUB_TOKEN": "test-token",
+    "GITHUB_REPOSITORY": "test/repo",
+    "GITHUB_RUN_ID": "12345",
+    "GITHUB_SHA": "test-sha",
+})
+
+# One annotation on a line inside the test diff, as render_annotations emits it
+SINGLE_REVIEW_COMMENTS = (
+    {"path": "file.py", "line": 1, "body": "❌ **CI Rescue Analysis**\n\nError message"},
+)
+# Summary comment body posted for the analysis "Test comment"
+EXPECTED_POST_BODY = f"{CI_RESCUE_COMMENT_MARKER}\nTest comment"
+
+
+def fake_comment(comment_id: int, body: str) -> SimpleNamespace:
+    """Lightweight stand-in for a PyGithub comment; only edit() records calls"""
+    return SimpleNamespace(id=comment_id, body=body, edit=MagicMock())
+
+
+def fake_response(status_code: int = 200, payload=None, links=None, headers=None) -> SimpleNamespace:
+    """Plain stand-in for a requests.Response carrying a JSON payload"""
+    return SimpleNamespace(
+        status_code=status_code, content=orjson.dumps(payload), links=links or {},
+        headers=headers or {}, close=lambda: None,
+    )
+
+
+def make_pr(**attrs) -> Mock:
+    """PullRequest mock that rejects attributes the real class doesn't have"""
+    return Mock(spec=PullRequest, **attrs)
 
-from github_client import GitHubClient
 
 class TestGitHubClient(unittest.TestCase):
     """Test GitHub client functionality"""
 
+    @classmethod
+    def setUpClass(cls):
+        # Patch once for the whole class rather than around every test
+        env_patcher = patch.dict(os.environ, ENV_VARS)
+        github_patcher = patch("github_client.Github")
+
+        env_patcher.start()
+        cls.addClassCleanup(env_patcher.stop)
+        cls.mock_github = github_patcher.start()
+        cls.addClassCleanup(github_patcher.stop)
+
     def setUp(self):
-        # Mock environment variables
-        self.env_vars = {
-            "INPUT_GITHUB_TOKEN": "test-token",
-            "GITHUB_REPOSITORY": "test/repo", 
-            "GITHUB_RUN_ID": "12345",
-            "GITHUB_SHA": "test-sha",
-        }
-
-        # Start patches
-        self.env_patcher = patch.dict(os.environ, self.env_vars)
-        self.github_patcher = patch("github_client.Github")
-        
-        self.env_patcher.start()
-        self.mock_github = self.github_patcher.start()
-        
+        self.mock_github.reset_mock()
         self.client = GitHubClient(
             os.getenv("INPUT_GITHUB_TOKEN"),
             os.getenv("GITHUB_REPOSITORY"),
             os.getenv("GITHUB_RUN_ID"),
         )
 
-    def tearDown(self):
-        self.env_patcher.stop()
-        self.github_patcher.stop()
-
-    def test_failing_scenario(self):
-        self.assertEqual(1, 2)
-
     def test_post_line_annotations_api_call(self):
         """Test that the GitHub review API is called correctly for line annotations"""
-        mock_pr = Mock()
+        mock_pr = make_pr()
         mock_pr.head.sha = "test-sha"
         mock_pr.number = 123
-        mock_commits = Mock()
-        mock_commits.reversed = [Mock()]  # Mock commit list
-        mock_pr.get_commits.return_value = mock_commits
-        mock_pr.create_review.return_value = Mock(id=456)
+        mock_commit = Mock()
+        mock_pr.base.repo.get_commit.return_value = mock_commit
+        mock_pr.get_files.return_value = [SimpleNamespace(filename="file.py", patch="@@ -0,0 +1,2 @@\n+a\n+b")]
+        mock_pr.create_review.return_value = SimpleNamespace(id=456)
 
-        review_comments = [
-            {
-                "path": "file.py",
-                "line": 1,
-                "body": "❌ **CI Rescue Analysis**\n\nError message",
-            }
-        ]
-
-        self.client.post_line_annotations(mock_pr, review_comments)
+        with patch.object(self.client, "_list_ci_rescue_annotations", return_value=[]):
+            self.client.post_line_annotations(mock_pr, SINGLE_REVIEW_COMMENTS)
 
         # Verify that create_review was called with the right data
+        mock_pr.base.repo.get_commit.assert_called_once_with("test-sha")
         mock_pr.create_review.assert_called_once()
         call_kwargs = mock_pr.create_review.call_args[1]
+        self.assertIs(call_kwargs["commit"], mock_commit)
         self.assertEqual(call_kwargs["event"], "COMMENT")
         self.assertEqual(len(call_kwargs["comments"]), 1)
         self.assertEqual(call_kwargs["comments"][0]["path"], "file.py")
         self.assertEqual(call_kwargs["comments"][0]["line"], 1)
         self.assertIn("CI Rescue Analysis", call_kwargs["comments"][0]["body"])
+        self.assertIn(CI_ANNOTATION_MARKER, call_kwargs["comments"][0]["body"])
 
-    @patch("requests.get")
-    def test_get_workflow_run_failures(self, mock_get):
-        """Test getting workflow run failures"""
-        # Mock the API response for jobs
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
+    def test_post_line_annotations_replaces_previous_only_after_review(self):
+        """Test that earlier annotations are deleted only once the new review is posted"""
+        mock_pr = make_pr(number=123)
+        mock_pr.head.sha = "test-sha"
+        mock_pr.get_files.return_value = [SimpleNamespace(filename="file.py", patch="@@ -0,0 +1,2 @@\n+a\n+b")]
+
+        mock_pr.create_review.side_effect = Exception("422 Unprocessable Entity")
+        with patch.object(self.client, "_list_ci_rescue_annotations", return_value=[1, 2]), \
+                patch.object(self.client, "_delete_annotations") as mock_delete:
+            self.client.post_line_annotations(mock_pr, SINGLE_REVIEW_COMMENTS)
+        mock_delete.assert_not_called()
+
+        mock_pr.create_review.side_effect = None
+        mock_pr.create_review.return_value = SimpleNamespace(id=458)
+        with patch.object(self.client, "_list_ci_rescue_annotations", return_value=[1, 2]), \
+                patch.object(self.client, "_delete_annotations") as mock_delete:
+            self.client.post_line_annotations(mock_pr, SINGLE_REVIEW_COMMENTS)
+        mock_delete.assert_called_once_with([1, 2])
+
+    def test_post_line_annotations_deletes_only_previous_ci_rescue_annotations(self):
+        """Test that a new review deletes only earlier CI Rescue annotations"""
+        first_page = fake_response(
+            payload=[{"id": 1, "body": f"{CI_ANNOTATION_MARKER}\nOld analysis"}],
+            links={"next": {"url": "https://api.github.com/page2"}},
+        )
+        second_page = fake_response(payload=[{"id": 2, "body": "Looks good to me"}])
+        mock_pr = make_pr(number=123)
+        mock_pr.head.sha = "test-sha"
+        mock_pr.get_files.return_value = [SimpleNamespace(filename="file.py", patch="@@ -0,0 +1,2 @@\n+a\n+b")]
+        mock_pr.create_review.return_value = SimpleNamespace(id=459)
+
+        with patch.object(self.client._session, "get", side_effect=[first_page, second_page]) as mock_get, \
+                patch.object(self.client._session, "delete", return_value=fake_response(204)) as mock_delete:
+            self.client.post_line_annotations(mock_pr, SINGLE_REVIEW_COMMENTS)
+
+        self.assertEqual(mock_get.call_args[0][0], "https://api.github.com/page2")
+        mock_delete.assert_called_once()
+        self.assertTrue(mock_delete.call_args[0][0].endswith("/repos/test/repo/pulls/comments/1"))
+        mock_pr.get_review_comments.assert_not_called()
+
+    def test_post_line_annotations_skips_lines_outside_diff(self):
+        """Test that only comments on lines inside the diff hunks are posted"""
+        mock_pr = make_pr()
+        mock_pr.head.sha = "test-sha"
+        mock_pr.get_files.return_value = [
+            SimpleNamespace(filename="file.py", patch="@@ -10,2 +10,3 @@\n ctx\n+new\n ctx"),
+            SimpleNamespace(filename="image.png", patch=None),
+        ]
+        mock_pr.create_review.return_value = SimpleNamespace(id=457)
+
+        review_comments = [
+            {"path": "file.py", "line": 11, "body": "In diff"},
+            {"path": "file.py", "line": 40, "body": "Outside hunk"},
+            {"path": "other.py", "line": 5, "body": "Unchanged file"},
+            {"path": "image.png", "line": 1, "body": "No patch"},
+        ]
+
+        with patch.object(self.client, "_list_ci_rescue_annotations", return_value=[]):
+            self.client.post_line_annotations(mock_pr, review_comments)
+
+        mock_pr.create_review.assert_called_once()
+        posted = mock_pr.create_review.call_args[1]["comments"]
+        self.assertEqual([(c["path"], c["line"]) for c in posted], [("file.py", 11)])
+
+    def test_build_diff_linemap(self):
+        """Test parsing right-side line ranges from diff hunk headers"""
+        mock_pr = make_pr()
+        mock_pr.get_files.return_value = [
+            SimpleNamespace(filename="a.py", patch="@@ -1,2 +1,3 @@\n a\n+b\n c\n@@ -20 +21 @@\n-x\n+y"),
+            SimpleNamespace(filename="b.py", patch="@@ -5,2 +4,0 @@\n-gone\n-gone"),
+        ]
+
+        linemap = self.client._build_diff_linemap(mock_pr)
+
+        self.assertEqual(linemap, {"a.py": {1, 2, 3, 21}, "b.py": set()})
+
+    @responses.activate
+    def test_get_workflow_run_failures(self):
+        """Test getting workflow run failures from a recorded jobs payload"""
+        responses.add(responses.GET, JOBS_URL_T.format(repo="test/repo", run_id="12345"),
+                      body=WORKFLOW_RUN_JOBS, status=200, content_type="application/json")
+        # GitHub redirects log downloads to a pre-signed blob URL
+        responses.add(responses.GET, JOB_LOGS_URL_T.format(repo="test/repo", job_id=123),
+                      status=302, headers={"Location": "https://blob.example/logs/123"})
+        responses.add(responses.GET, "https://blob.example/logs/123", body="test logs", status=206)
+
+        failures = self.client.get_workflow_run_failures()
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].job_name, "test-job")
+        self.assertEqual(failures[0].step_name, "test-step")
+        self.assertEqual(failures[0].logs, "test logs")
+        self.assertNotIn("Authorization", responses.calls[-1].request.headers)
+
+    def test_get_workflow_run_failures_fetches_logs_once_per_job(self):
+        """Test that a job with several failed steps downloads its logs once"""
+        mock_response = fake_response(payload={
             "jobs": [{
                 "id": 123,
                 "name": "test-job",
                 "conclusion": "failure",
-                "steps": [{"name": "test-step", "conclusion": "failure"}]
+                "steps": [
+                    {"name": "lint", "conclusion": "failure"},
+                    {"name": "test", "conclusion": "failure"},
+                ]
             }]
-        }
-        mock_get.return_value = mock_response
-        
-        # Mock the get_job_logs method
-        with patch.object(self.client, 'get_job_logs', return_value="test logs"):
+        })
+
+        # The client is rebuilt for every test, so a plain attribute swap needs no undo
+        self.client.get_job_logs = mock_logs = Mock(return_value="test logs")
+        with patch.object(self.client._session, "get", return_value=mock_response):
             failures = self.client.get_workflow_run_failures()
-            
-        self.assertEqual(len(failures), 1)
-        self.assertEqual(failures[0].job_name, "test-job")
-        self.assertEqual(failures[0].step_name, "test-step")
-        self.assertEqual(failures[0].logs, "test logs")
+
+        mock_logs.assert_called_once_with(123)
+        self.assertEqual([f.step_name for f in failures], ["lint", "test"])
+
+    def test_get_workflow_run_failures_follows_jobs_pages(self):
+        """Test that failed jobs past the first page of the jobs listing are found"""
+        def job(job_id, conclusion):
+            return {"id": job_id, "name": f"job-{job_id}", "conclusion": conclusion,
+                    "steps": [{"name": "step", "conclusion": conclusion}]}
+
+        first_page = fake_response(
+            payload={"jobs": [job(1, "success"), job(2, "failure")]},
+            links={"next": {"url": "https://api.github.com/page2"}},
+        )
+        second_page = fake_response(payload={"jobs": [job(3, "failure")]})
+
+        self.client.get_job_logs = lambda job_id: "test logs"
+        with patch.object(self.client._session, "get", side_effect=[first_page, second_page]) as mock_get:
+            failures = self.client.get_workflow_run_failures()
+
+        self.assertIn("per_page=100", mock_get.call_args_list[0][0][0])
+        self.assertEqual([f.job_name for f in failures], ["job-2", "job-3"])
+
+    def test_get_workflow_run_failures_uses_log_cache(self):
+        """Test that completed jobs' logs are reused from the persistent cache"""
+        mock_response = fake_response(payload={
+            "jobs": [{
+                "id": 123,
+                "name": "test-job",
+                "conclusion": "failure",
+                "completed_at": "2024-01-01T00:00:00Z",
+                "steps": [{"name": "test-step", "conclusion": "failure"}]
+            }]
+        })
+
+        logs_response = MagicMock()
+        logs_response.__enter__.return_value = logs_response
+        logs_response.status_code = 200
+        logs_response.is_redirect = False
+        logs_response.iter_content.return_value = [b"cached logs"]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # The first run lists jobs and downloads the logs; the second only lists jobs
+            for expected_downloads, replies in ((1, [mock_response, logs_response]), (0, [mock_response])):
+                client = GitHubClient("test-token", "test/repo", "12345", cache_dir=cache_dir)
+                with patch.object(client._session, "get", side_effect=replies) as mock_get:
+                    failures = client.get_workflow_run_failures()
+                client.close()
+
+                log_calls = [c for c in mock_get.call_args_list if c[0][0].endswith("/logs")]
+                self.assertEqual(len(log_calls), expected_downloads)
+                self.assertEqual(failures[0].logs, "cached logs")
+
+    def test_get_job_logs_keeps_tail(self):
+        """Test that streamed job logs are trimmed to their last characters"""
+        mock_response = MagicMock()
+        mock_response.__enter__.return_value = mock_response
+        mock_response.status_code = 200
+        mock_response.is_redirect = False
+        mock_response.iter_content.return_value = [b"x" * 70000, b"y" * 4000, b"end"]
+
+        with patch.object(self.client._session, "get", return_value=mock_response):
+            logs = self.client.get_job_logs(42)
+
+        self.assertEqual(len(logs), 5000)
+        self.assertTrue(logs.endswith("y" * 4000 + "end"))
+
+    def test_wait_for_rate_limit(self):
+        """Test that a throttled response pauses until its reset, capped, and others don't"""
+        exhausted = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1030"}
+        throttled = SimpleNamespace(status_code=429, headers=exhausted)
+        last_call = SimpleNamespace(status_code=200, headers=exhausted)
+        rejected_write = SimpleNamespace(status_code=403, headers=exhausted,
+                                         request=SimpleNamespace(method="POST"))
+        bad_reset = SimpleNamespace(status_code=429,
+                                    headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "soon"})
+
+        with patch("github_client.time.time", return_value=1000), \
+                patch("github_client.time.sleep") as mock_sleep:
+            for response in (last_call, rejected_write, bad_reset):
+                self.assertIs(wait_for_rate_limit(response), response)
+            mock_sleep.assert_not_called()
+            self.assertIs(wait_for_rate_limit(throttled), throttled)
+
+        mock_sleep.assert_called_once_with(30)
+
+    @responses.activate
+    def test_session_retries_only_rate_limited_403(self):
+        """Test that a 403 is resent once after a rate-limit wait, and a plain 403 is returned"""
+        url = JOBS_URL_T.format(repo="test/repo", run_id="12345")
+        session = create_session("test-token")
+
+        responses.add(responses.GET, url, status=403, headers={"Retry-After": "2"})
+        responses.add(responses.GET, url, body=WORKFLOW_RUN_JOBS)
+        with patch("github_client.time.sleep") as mock_sleep:
+            self.assertEqual(session.get(url).status_code, 200)
+        mock_sleep.assert_called_once_with(2.0)
+        self.assertEqual(len(responses.calls), 2)
+
+        responses.replace(responses.GET, url, status=403, json={"message": "Resource not accessible"})
+        with patch("github_client.time.sleep") as mock_sleep:
+            self.assertEqual(session.get(url).status_code, 403)
+        mock_sleep.assert_not_called()
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_session_returns_response_after_exhausted_retries(self):
+        """Test that the retrying adapter returns the last 5xx response instead of raising"""
+        url = JOBS_URL_T.format(repo="test/repo", run_id="12345")
+        session = create_session("test-token")
+
+        responses.add(responses.GET, url, status=502)
+        with patch("urllib3.util.retry.Retry.sleep"):
+            response = session.get(url)
+
+        self.assertEqual(response.status_code, 502)
+        # The first attempt plus five retries
+        self.assertEqual(len(responses.calls), 6)
+
+    def test_get_job_logs_requests_tail_range_from_blob(self):
+        """Test that the log redirect is followed with a tail Range and without the token"""
+        redirect = MagicMock(is_redirect=True, headers={"Location": "https://blob.example/log"})
+        redirect.__enter__.return_value = redirect
+        blob = MagicMock(status_code=206)
+        blob.__enter__.return_value = blob
+        blob.iter_content.return_value = [b"tail of the log"]
+
+        with patch.object(self.client._session, "get", side_effect=[redirect, blob]) as mock_get:
+            logs = self.client.get_job_logs(42)
+
+        self.assertEqual(logs, "tail of the log")
+        self.assertFalse(mock_get.call_args_list[0][1]["allow_redirects"])
+        self.assertEqual(mock_get.call_args_list[1][0][0], "https://blob.example/log")
+        self.assertEqual(mock_get.call_args_list[1][1]["headers"],
+                         {"Authorization": None, "Range": "bytes=-20000"})
+
+    def test_get_job_logs_empty_log_range_not_satisfiable(self):
+        """Test that a 416 for the tail of an empty log yields empty logs"""
+        redirect = MagicMock(is_redirect=True, headers={"Location": "https://blob.example/log"})
+        redirect.__enter__.return_value = redirect
+        blob = MagicMock(status_code=416)
+        blob.__enter__.return_value = blob
+
+        with patch.object(self.client._session, "get", side_effect=[redirect, blob]):
+            self.assertEqual(self.client.get_job_logs(43), "")
 
     def test_get_pull_request(self):
         """Test getting pull request for workflow run"""
@@ -107,28 +368,104 @@ class TestGitHubClient(unittest.TestCase):
         self.client.event_name = "push"  # Use non-PR event for simplicity
         
         mock_repo = Mock()
-        mock_pr = Mock()
-        mock_pr.head.sha = "test-sha"  # Match the client sha
+        mock_pr = make_pr()
+        mock_response = fake_response(payload=[
+            {"number": 7, "state": "closed", "head": {"sha": "test-sha"}},
+            {"number": 8, "state": "open", "head": {"sha": "test-sha"}},
+        ])
         
         # Mock the github client
         self.client.github.get_repo.return_value = mock_repo
-        mock_repo.get_pulls.return_value = [mock_pr]
+        mock_repo.get_pull.return_value = mock_pr
         
-        pr = self.client.get_pull_request()
+        with patch.object(self.client._session, "get", return_value=mock_response) as mock_get:
+            pr = self.client.get_pull_request()
         
         self.assertEqual(pr, mock_pr)
+        mock_repo.get_pull.assert_called_once_with(8)
+        self.assertTrue(mock_get.call_args[0][0].endswith("/repos/test/repo/commits/test-sha/pulls"))
+        mock_repo.get_pulls.assert_not_called()
+        self.client.github.get_repo.assert_called_once_with("test/repo", lazy=True)
+
+    def test_get_pull_request_from_event(self):
+        """Test that pull_request events read the PR number from the event payload once"""
+        self.client.event_name = "pull_request"
+        mock_repo = self.client.github.get_repo.return_value
+
+        with tempfile.NamedTemporaryFile("wb", suffix=".json", delete=False) as f:
+            f.write(orjson.dumps({"pull_request": {"number": 5}}))
+        self.addCleanup(os.remove, f.name)
+        load_event.cache_clear()
+        self.addCleanup(load_event.cache_clear)
+
+        with patch.dict(os.environ, {"GITHUB_EVENT_PATH": f.name}), \
+                patch("builtins.open", wraps=open) as mock_open:
+            self.client.get_pull_request()
+            self.client.get_pull_request()
+
+        mock_open.assert_called_once()
+        self.assertEqual(mock_repo.get_pull.call_args_list, [((5,),), ((5,),)])
 
     def test_post_or_update_comment(self):
         """Test posting or updating PR comment"""
-        mock_pr = Mock()
+        mock_pr = make_pr()
         mock_pr.get_issue_comments.return_value = []
         
         self.client.post_or_update_comment(mock_pr, "Test comment")
         
         # Should create new comment when none exist
-        expected_body = "<!-- CI-RESCUE-COMMENT -->\nTest comment"
-        mock_pr.create_issue_comment.assert_called_once_with(expected_body)
+        mock_pr.create_issue_comment.assert_called_once_with(EXPECTED_POST_BODY)
+
+    def test_post_or_update_comment_reuses_comment_id(self):
+        """Test that a second update in the same run skips the comment scan"""
+        mock_comment = fake_comment(99, f"{CI_RESCUE_COMMENT_MARKER}\nOld")
+        mock_pr = make_pr()
+        mock_pr.get_issue_comments.return_value = [mock_comment]
+
+        with patch.object(self.client._session, "patch", return_value=fake_response()) as mock_patch:
+            self.client.post_or_update_comment(mock_pr, "First")
+            self.client.post_or_update_comment(mock_pr, "Second")
+
+        mock_pr.get_issue_comments.assert_called_once()
+        mock_patch.assert_called_once()
+        self.assertTrue(mock_patch.call_args[0][0].endswith("/repos/test/repo/issues/comments/99"))
+        self.assertEqual(orjson.loads(mock_patch.call_args[1]["data"]),
+                         {"body": f"{CI_RESCUE_COMMENT_MARKER}\nSecond"})
+        mock_pr.create_issue_comment.assert_not_called()
+
+    def test_post_or_update_comment_uses_cached_comment_id(self):
+        """Test that a comment id remembered by an earlier run is edited directly"""
+        mock_pr = make_pr(number=123)
+        mock_pr.get_issue_comments.return_value = []
+        mock_pr.create_issue_comment.return_value = SimpleNamespace(id=77)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first_run = GitHubClient("test-token", "test/repo", "1", cache_dir=cache_dir)
+            first_run.post_or_update_comment(mock_pr, "First")
+            first_run.close()
+
+            second_run = GitHubClient("test-token", "test/repo", "2", cache_dir=cache_dir)
+            with patch.object(second_run._session, "patch", return_value=fake_response()) as mock_patch:
+                second_run.post_or_update_comment(mock_pr, "Second")
+            second_run.close()
+
+        self.assertTrue(mock_patch.call_args[0][0].endswith("/issues/comments/77"))
+        mock_pr.create_issue_comment.assert_called_once()
+        mock_pr.get_issue_comments.assert_called_once()
+
+    def test_post_or_update_comment_falls_back_when_edit_raises(self):
+        """Test that a failed PATCH of the remembered comment falls back to the scan"""
+        mock_comment = fake_comment(99, f"{CI_RESCUE_COMMENT_MARKER}\nOld")
+        mock_pr = make_pr(number=123)
+        mock_pr.get_issue_comments.return_value = [mock_comment]
+        self.client._comment_id = 99
+
+        with patch.object(self.client._session, "patch",
+                          side_effect=requests.exceptions.ConnectionError("reset")):
+            self.client.post_or_update_comment(mock_pr, "Test comment")
 
+        mock_comment.edit.assert_called_once_with(EXPECTED_POST_BODY)
+        mock_pr.create_issue_comment.assert_not_called()
 
 if __name__ == "__main__":
     unittest.main()
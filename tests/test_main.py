@@ -3,53 +3,134 @@
 Tests for CI Rescue action
 """
 
-import unittest
-from unittest.mock import Mock, patch
+import contextlib
+import dataclasses
+from unittest.mock import patch
 import os
-import sys
+import tempfile
+from types import MappingProxyType, SimpleNamespace
 
-# Add src to path for imports
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import orjson
+import pytest
+import responses
 
-from main import CIRescue
+from annotations import parse_analysis, render_annotations
+from main import CIRescue, main
 from models import FailureInfo
-from openrouter_client import OpenRouterClient
-
-
-class TestOpenRouterClient(unittest.TestCase):
-    """Test OpenRouter client functionality"""
-    
-    def setUp(self):
-        self.client = OpenRouterClient("test-api-key", "test-model")
-
-    def test_initialization(self):
-        """Test OpenRouterClient initialization"""
-        client = OpenRouterClient("test-key", "test-model")
-        self.assertEqual(client.api_key, "test-key")
-        self.assertEqual(client.model, "test-model")
-        self.assertEqual(client.base_url, "https://openrouter.ai/api/v1")
-
-    def test_extract_error_context_empty_logs(self):
-        """Test _extract_error_context with empty logs"""
-        result = self.client._extract_error_context("")
-        self.assertEqual(result, "No logs available")
-
-    def test_extract_error_context_no_errors(self):
-        """Test _extract_error_context when no error indicators are found"""
-        logs = """Starting application
+from openrouter_client import MAX_SCAN_LOG_CHARS, OpenRouterClient
+
+
+# Mock environment variables, read-only so no test can leak changes into another
+ENV_VARS = MappingProxyType({
+    "INPUT_GITHUB_TOKEN": "test-token",
+    "INPUT_OPENROUTER_API_KEY": "test-openrouter-key",
+    "INPUT_MODEL": "test-model",
+    "INPUT_MAX_TOKENS": "500",
+    "INPUT_INCLUDE_LOGS": "true",
+    "INPUT_COMMENT_MODE": "update-existing",
+    "GITHUB_REPOSITORY": "test/repo",
+    "GITHUB_SHA": "test-sha",
+    "GITHUB_RUN_ID": "12345",
+    "GITHUB_EVENT_NAME": "pull_request",
+})
+
+# Endpoint every analysis request is posted to
+COMPLETIONS_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Body of a successful analysis reply
+ANALYSIS_REPLY = orjson.dumps({
+    "choices": [{"message": {"content": "Test analysis result"}}]
+})
+
+# FailureInfo is frozen, so tests can share one sample
+SAMPLE_FAILURE = FailureInfo("test-job", "test-step", "test error", "test logs", "failure")
+
+
+@pytest.fixture(scope="module")
+def client():
+    """OpenRouter client shared by the module; it holds no per-test state"""
+    client = OpenRouterClient("test-api-key", "test-model")
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope="module")
+def _http_stub():
+    """One HTTP stub installed for the whole module"""
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as stub:
+        yield stub
+
+
+@pytest.fixture
+def http(_http_stub):
+    """The module's HTTP stub, emptied after each test"""
+    yield _http_stub
+    _http_stub.reset()
+
+
+@contextlib.contextmanager
+def patched_clients():
+    """Patch both client classes CIRescue builds, entered and exited as one"""
+    with contextlib.ExitStack() as stack:
+        yield tuple(
+            stack.enter_context(patch(target))
+            for target in ("github_client.GitHubClient", "openrouter_client.OpenRouterClient")
+        )
+
+
+@pytest.fixture
+def clients():
+    """Fresh GitHub and OpenRouter client mocks for CIRescue to pick up"""
+    with patched_clients() as (github_class, openrouter_class):
+        yield github_class.return_value, openrouter_class.return_value
+
+
+@pytest.fixture(scope="module")
+def ci_env():
+    """ENV_VARS set once for the rest of the module"""
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in ENV_VARS.items():
+            mp.setenv(name, value)
+        yield
+
+
+@pytest.fixture(scope="module")
+def rescue(ci_env):
+    """CIRescue shared by tests that only read its configuration"""
+    with patched_clients():
+        return CIRescue()
+
+
+@pytest.fixture
+def fresh_rescue(ci_env, clients):
+    """CIRescue built around this test's client mocks, for tests that run it"""
+    return CIRescue()
+
+
+# OpenRouter client
+
+def test_extract_error_context_empty_logs(client):
+    """Test _extract_error_context with empty logs"""
+    assert client._extract_error_context("") == "No logs available"
+
+
+def test_extract_error_context_no_errors(client):
+    """Test _extract_error_context when no error indicators are found"""
+    logs = """Starting application
 Loading configuration
 Processing request
 Application ready
 Shutting down gracefully"""
 
-        result = self.client._extract_error_context(logs)
-        # Should return last 10 lines as fallback
-        self.assertIn("Application ready", result)
-        self.assertIn("Shutting down gracefully", result)
+    result = client._extract_error_context(logs)
+    # Should return last 10 lines as fallback
+    assert "Application ready" in result
+    assert "Shutting down gracefully" in result
+
 
-    def test_extract_error_context_single_error(self):
-        """Test _extract_error_context with a single error"""
-        logs = """Line 1: Starting process
+def test_extract_error_context_single_error(client):
+    """Test _extract_error_context with a single error"""
+    logs = """Line 1: Starting process
 Line 2: Loading module
 Line 3: Initializing database
 Line 4: Connecting to server
@@ -60,22 +141,20 @@ Line 8: Failed to recover
 Line 9: Shutting down
 Line 10: Process ended"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
 
-        # Should contain 5 lines before and 5 lines after the error
-        self.assertIn("Line 1: Starting process", result)  # 5 lines before
-        self.assertIn("Line 6: ERROR: Connection timeout", result)  # error line
-        self.assertIn(
-            "Line 10: Process ended", result
-        )  # 5 lines after (only 4 available)
+    # Should contain 5 lines before and 5 lines after the error
+    assert "Line 1: Starting process" in result  # 5 lines before
+    assert "Line 6: ERROR: Connection timeout" in result  # error line
+    assert "Line 10: Process ended" in result  # 5 lines after (only 4 available)
 
-        # Should not contain extra lines
-        lines = result.split("\n")
-        self.assertEqual(len(lines), 10)  # 10 total lines in context
+    # Should not contain extra lines
+    assert len(result.split("\n")) == 10  # 10 total lines in context
 
-    def test_extract_error_context_multiple_errors_separate(self):
-        """Test _extract_error_context with multiple separate errors"""
-        logs = """Line 1: Starting
+
+def test_extract_error_context_multiple_errors_separate(client):
+    """Test _extract_error_context with multiple separate errors"""
+    logs = """Line 1: Starting
 Line 2: ERROR: First error
 Line 3: Recovery attempt
 Line 4: Normal operation
@@ -91,16 +170,17 @@ Line 13: FAILED: Second error
 Line 14: Cleanup
 Line 15: Finished"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
+
+    # Should contain two separate context blocks
+    assert "---" in result  # Separator between blocks
+    assert "ERROR: First error" in result
+    assert "FAILED: Second error" in result
 
-        # Should contain two separate context blocks
-        self.assertIn("---", result)  # Separator between blocks
-        self.assertIn("ERROR: First error", result)
-        self.assertIn("FAILED: Second error", result)
 
-    def test_extract_error_context_overlapping_errors(self):
-        """Test _extract_error_context with overlapping error contexts"""
-        logs = """Line 1: Starting
+def test_extract_error_context_overlapping_errors(client):
+    """Test _extract_error_context with overlapping error contexts"""
+    logs = """Line 1: Starting
 Line 2: Loading
 Line 3: ERROR: First error
 Line 4: Processing
@@ -108,20 +188,20 @@ Line 5: FAILED: Second error
 Line 6: Recovery
 Line 7: Finished"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
+
+    # Should merge overlapping ranges into one block
+    assert "---" not in result  # No separator since ranges merged
+    assert "ERROR: First error" in result
+    assert "FAILED: Second error" in result
 
-        # Should merge overlapping ranges into one block
-        self.assertNotIn("---", result)  # No separator since ranges merged
-        self.assertIn("ERROR: First error", result)
-        self.assertIn("FAILED: Second error", result)
+    # Should contain all lines since they're close together
+    assert len(result.split("\n")) == 7  # All 7 lines included
 
-        # Should contain all lines since they're close together
-        lines = result.split("\n")
-        self.assertEqual(len(lines), 7)  # All 7 lines included
 
-    def test_extract_error_context_case_insensitive(self):
-        """Test case-insensitive error detection"""
-        logs = """Line 1: Starting
+def test_extract_error_context_case_insensitive(client):
+    """Test case-insensitive error detection"""
+    logs = """Line 1: Starting
 Line 2: error: lowercase error
 Line 3: Normal
 Line 4: Error: Mixed case error
@@ -129,16 +209,28 @@ Line 5: Normal
 Line 6: ERROR: Uppercase error
 Line 7: Finished"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
 
-        # Should find all three error variations
-        self.assertIn("error: lowercase error", result)
-        self.assertIn("Error: Mixed case error", result)
-        self.assertIn("ERROR: Uppercase error", result)
+    # Should find all three error variations
+    assert "error: lowercase error" in result
+    assert "Error: Mixed case error" in result
+    assert "ERROR: Uppercase error" in result
 
-    def test_extract_error_context_different_indicators(self):
-        """Test different types of error indicators"""
-        logs = """Line 1: Starting
+
+def test_extract_error_context_length_changing_lowercase(client):
+    """Test that characters which grow when lowercased don't shift the error lines"""
+    filler = [f"Line {i}: İstanbul deploy" for i in range(1, 21)]
+    logs = "\n".join(filler + ["Line 21: ERROR: Upload failed"] + filler[:3])
+
+    result = client._extract_error_context(logs)
+
+    assert "Line 21: ERROR: Upload failed" in result
+    assert result.startswith("Line 16:")
+
+
+def test_extract_error_context_different_indicators(client):
+    """Test different types of error indicators"""
+    logs = """Line 1: Starting
 Line 2: Exception: Runtime exception
 Line 3: Normal
 Line 4: Traceback (most recent call last):
@@ -150,363 +242,439 @@ Line 9: Normal
 Line 10: FAILURE: Build failed
 Line 11: Finished"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
+
+    # Should detect various error types
+    assert "Exception: Runtime exception" in result
+    assert "Traceback" in result
+    assert "SyntaxError" in result
+    assert "##[error]" in result
+    assert "FAILURE:" in result
 
-        # Should detect various error types
-        self.assertIn("Exception: Runtime exception", result)
-        self.assertIn("Traceback", result)
-        self.assertIn("SyntaxError", result)
-        self.assertIn("##[error]", result)
-        self.assertIn("FAILURE:", result)
 
-    def test_extract_error_context_error_at_start(self):
-        """Test error at the very beginning of logs"""
-        logs = """ERROR: Error at start
+def test_extract_error_context_error_at_start(client):
+    """Test error at the very beginning of logs"""
+    logs = """ERROR: Error at start
 Line 2: Recovery
 Line 3: Normal
 Line 4: Normal
 Line 5: Normal
 Line 6: Finished"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
 
-        # Should handle error at start gracefully (no lines before)
-        self.assertIn("ERROR: Error at start", result)
-        self.assertIn("Line 6: Finished", result)  # Should still get 5 lines after
+    # Should handle error at start gracefully (no lines before)
+    assert "ERROR: Error at start" in result
+    assert "Line 6: Finished" in result  # Should still get 5 lines after
 
-    def test_extract_error_context_error_at_end(self):
-        """Test error at the very end of logs"""
-        logs = """Line 1: Starting
+
+def test_extract_error_context_error_at_end(client):
+    """Test error at the very end of logs"""
+    logs = """Line 1: Starting
 Line 2: Normal
 Line 3: Normal
 Line 4: Normal
 Line 5: Normal
 Line 6: ERROR: Error at end"""
 
-        result = self.client._extract_error_context(logs)
+    result = client._extract_error_context(logs)
+
+    # Should handle error at end gracefully (no lines after)
+    assert "Line 1: Starting" in result  # Should get 5 lines before
+    assert "ERROR: Error at end" in result
 
-        # Should handle error at end gracefully (no lines after)
-        self.assertIn("Line 1: Starting", result)  # Should get 5 lines before
-        self.assertIn("ERROR: Error at end", result)
 
-    def test_extract_error_context_whitespace_handling(self):
-        """Test proper whitespace handling with rstrip()"""
-        logs = """Line 1: Normal    
+def test_extract_error_context_whitespace_handling(client):
+    """Test proper whitespace handling with rstrip()"""
+    logs = """Line 1: Normal    
 Line 2: ERROR: Error with trailing spaces   \t
 Line 3: Normal\n\n
 Line 4: Finished"""
 
-        result = self.client._extract_error_context(logs)
-
-        # Should remove trailing whitespace but preserve structure
-        lines = result.split("\n")
-        for line in lines:
-            self.assertFalse(line.endswith(" "))  # No trailing spaces
-            self.assertFalse(line.endswith("\t"))  # No trailing tabs
-
-        self.assertIn("ERROR: Error with trailing spaces", result)
-
-    def test_extract_error_context_limit_blocks(self):
-        """Test limiting to max 3 context blocks"""
-        # Create logs with 5 separate errors (far apart)
-        logs_parts = []
-        for i in range(5):
-            logs_parts.append(f"Section {i + 1} start")
-            for j in range(10):  # Add padding lines
-                logs_parts.append(f"Section {i + 1} line {j + 1}")
-            logs_parts.append(f"ERROR: Error {i + 1}")
-            for j in range(10):  # Add more padding
-                logs_parts.append(f"Section {i + 1} end line {j + 1}")
-
-        logs = "\n".join(logs_parts)
-        result = self.client._extract_error_context(logs)
-
-        # Should only contain last 3 errors
-        self.assertNotIn("ERROR: Error 1", result)
-        self.assertNotIn("ERROR: Error 2", result)
-        self.assertIn("ERROR: Error 3", result)
-        self.assertIn("ERROR: Error 4", result)
-        self.assertIn("ERROR: Error 5", result)
-
-        # Should have 2 separators (3 blocks)
-        self.assertEqual(result.count("---"), 2)
-
-    def test_init(self):
-        """Test client initialization"""
-        self.assertEqual(self.client.api_key, "test-api-key")
-        self.assertEqual(self.client.model, "test-model")
-        self.assertEqual(self.client.base_url, "https://openrouter.ai/api/v1")
-    
-    @patch("requests.post")
-    def test_analyze_failure_success(self, mock_post):
-        """Test successful failure analysis"""
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "choices": [{"message": {"content": "Test analysis result"}}]
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
-        
-        failure_info = FailureInfo(
-            job_name="test-job",
-            step_name="test-step", 
-            error_message="test error",
-            logs="test logs",
-            conclusion="failure",
-        )
-        
-        result = self.client.analyze_failure(failure_info)
-        self.assertEqual(result, "Test analysis result")
-        mock_post.assert_called_once()
-    
-    @patch("requests.post")
-    def test_analyze_failure_error(self, mock_post):
-        """Test failure analysis with API error"""
-        mock_post.side_effect = Exception("API Error")
-        
-        failure_info = FailureInfo(
-            job_name="test-job",
-            step_name="test-step",
-            error_message="test error", 
-            logs="test logs",
-            conclusion="failure",
+    result = client._extract_error_context(logs)
+
+    # Should remove trailing whitespace but preserve structure
+    for line in result.split("\n"):
+        assert not line.endswith(" ")  # No trailing spaces
+        assert not line.endswith("\t")  # No trailing tabs
+
+    assert "ERROR: Error with trailing spaces" in result
+
+
+def test_extract_error_context_limit_blocks(client):
+    """Test limiting to max 3 context blocks"""
+    # Create logs with 5 separate errors (far apart), each padded by 10 lines on both sides
+    def section(n):
+        yield f"Section {n} start"
+        yield from (f"Section {n} line {j}" for j in range(1, 11))
+        yield f"ERROR: Error {n}"
+        yield from (f"Section {n} end line {j}" for j in range(1, 11))
+
+    logs = "\n".join(line for n in range(1, 6) for line in section(n))
+    result = client._extract_error_context(logs)
+
+    # Should only contain last 3 errors
+    assert "ERROR: Error 1" not in result
+    assert "ERROR: Error 2" not in result
+    assert "ERROR: Error 3" in result
+    assert "ERROR: Error 4" in result
+    assert "ERROR: Error 5" in result
+
+    # Should have 2 separators (3 blocks)
+    assert result.count("---") == 2
+
+
+def test_extract_error_context_scans_only_log_tail(client):
+    """Test that only whole lines from the last MAX_SCAN_LOG_CHARS are scanned"""
+    logs = "ERROR: early failure\n" + "x" * MAX_SCAN_LOG_CHARS + "\nLine: tail ok"
+
+    assert client._extract_error_context(logs) == "Line: tail ok"
+
+
+def test_extract_error_context_memoized(client):
+    """Test that the same log is only scanned once"""
+    logs = "Line 1\nERROR: memoized failure\nLine 3"
+    OpenRouterClient._extract_error_context.cache_clear()
+    first = client._extract_error_context(logs)
+    second = client._extract_error_context(logs)
+    assert first == second
+    assert OpenRouterClient._extract_error_context.cache_info().hits == 1
+
+
+def test_init(client):
+    """Test client initialization"""
+    assert (client.api_key, client.model, client.base_url) == (
+        "test-api-key", "test-model", "https://openrouter.ai/api/v1"
+    )
+    assert client._session.headers["Authorization"] == "Bearer test-api-key"
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ({"body": ANALYSIS_REPLY}, ("Test analysis result",)),
+    (
+        {"body": Exception("API Error")},
+        ("🚨 **CI Failure Analysis**", "Failed to analyze the error with AI"),
+    ),
+], ids=["success", "error"])
+def test_analyze_failure(http, client, reply, expected):
+    """Test failure analysis with a successful reply and with an API error"""
+    http.post(COMPLETIONS_URL, **reply)
+
+    result = client.analyze_failure(SAMPLE_FAILURE)
+    for fragment in expected:
+        assert fragment in result
+    assert len(http.calls) == 1
+
+
+@patch("openrouter_client.time.sleep")
+def test_analyze_failure_retries_rate_limit(mock_sleep, http, client):
+    """Test that a 429 is retried after the server's Retry-After delay"""
+    http.post(COMPLETIONS_URL, status=429, headers={"Retry-After": "3"})
+    http.post(COMPLETIONS_URL, body=ANALYSIS_REPLY)
+
+    assert client.analyze_failure(SAMPLE_FAILURE) == "Test analysis result"
+    assert len(http.calls) == 2
+    mock_sleep.assert_called_once_with(3.0)
+
+
+@patch("openrouter_client.time.monotonic", return_value=100.0)
+@patch("openrouter_client.time.sleep")
+def test_requests_per_minute_spaces_requests(mock_sleep, mock_monotonic):
+    """Test that request starts are spaced evenly under the RPM limit"""
+    client = OpenRouterClient("test-api-key", "test-model", requests_per_minute=60)
+    for _ in range(3):
+        client._wait_for_rate_slot()
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1.0, 2.0]
+
+
+def test_analyze_failure_uses_cache(http):
+    """Test that a cached analysis is reused unless bypassed, and failures are not cached"""
+    http.post(COMPLETIONS_URL, body=Exception("API Error"))
+    http.post(COMPLETIONS_URL, body=ANALYSIS_REPLY)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = OpenRouterClient("test-api-key", "test-model", cache_dir=cache_dir)
+        assert "Failed to analyze the error with AI" in client.analyze_failure(SAMPLE_FAILURE)
+        assert client.analyze_failure(SAMPLE_FAILURE) == "Test analysis result"
+        assert client.analyze_failure(SAMPLE_FAILURE, no_cache=True) == "Test analysis result"
+        client.close()
+
+    assert len(http.calls) == 3
+
+
+def test_analyze_failure_cache_ignores_run_noise(http):
+    """Test that reruns differing only in timestamps and durations share a cache entry"""
+    http.post(COMPLETIONS_URL, body=ANALYSIS_REPLY)
+
+    def failure(stamp, duration):
+        return dataclasses.replace(
+            SAMPLE_FAILURE,
+            logs=f"{stamp} ERROR: test_parse failed\n{stamp} 1 failed in {duration}",
         )
-        
-        result = self.client.analyze_failure(failure_info)
-        self.assertIn("🚨 **CI Failure Analysis**", result)
-        self.assertIn("Failed to analyze the error with AI", result)
-
-
-class TestCIRescue(unittest.TestCase):
-    """Test CI Rescue main functionality"""
-    
-    def setUp(self):
-        # Mock environment variables
-        self.env_vars = {
-            "INPUT_GITHUB_TOKEN": "test-token",
-            "INPUT_OPENROUTER_API_KEY": "test-openrouter-key",
-            "INPUT_MODEL": "test-model",
-            "INPUT_MAX_TOKENS": "500",
-            "INPUT_INCLUDE_LOGS": "true",
-            "INPUT_COMMENT_MODE": "update-existing",
-            "GITHUB_REPOSITORY": "test/repo",
-            "GITHUB_SHA": "test-sha",
-            "GITHUB_RUN_ID": "12345",
-            "GITHUB_EVENT_NAME": "pull_request",
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = OpenRouterClient("test-api-key", "test-model", cache_dir=cache_dir)
+        client.analyze_failure(failure("2024-05-01T10:00:00.1234567Z", "1.52s"))
+        client.analyze_failure(failure("2024-05-02T11:30:00.7654321Z", "1.48s"))
+        client.close()
+
+    assert len(http.calls) == 1
+
+
+# CI Rescue
+
+def test_init_missing_vars(clients):
+    """Test initialization with missing environment variables"""
+    with patch.dict(os.environ, {}, clear=True):
+        with pytest.raises(ValueError):
+            CIRescue()
+
+    partial = {k: v for k, v in ENV_VARS.items() if k != "INPUT_OPENROUTER_API_KEY"}
+    with patch.dict(os.environ, partial, clear=True):
+        with pytest.raises(ValueError, match="INPUT_OPENROUTER_API_KEY$"):
+            CIRescue()
+
+
+def test_init_rejects_zero_max_concurrent(ci_env, clients):
+    """Test that a max-concurrent of 0 is rejected before any client is built"""
+    with patch.dict(os.environ, {"INPUT_MAX_CONCURRENT": "0"}):
+        with pytest.raises(ValueError, match="INPUT_MAX_CONCURRENT must be at least 1"):
+            CIRescue()
+
+
+def test_main_closes_clients(ci_env, clients):
+    """Test that main releases both clients once the run is over"""
+    github, openrouter = clients
+    github.get_workflow_run_failures.return_value = []
+
+    main()
+
+    github.__exit__.assert_called_once()
+    openrouter.__exit__.assert_called_once()
+
+
+def test_init_success(rescue):
+    """Test successful initialization"""
+    assert (rescue.github_token, rescue.openrouter_api_key, rescue.model, rescue.max_tokens) == (
+        "test-token", "test-openrouter-key", "test-model", 500
+    )
+
+
+def test_parse_analysis_with_valid_annotations():
+    """Test parsing analysis with a valid annotation block"""
+    valid_annotation_json = """{
+      "annotations": [
+        {"path": "src/main.py", "start_line": 10, "message": "Test annotation"}
+      ]
+    }"""
+    analysis_text = f"This is the analysis.<<<CI-RESCUE-ANNOTATIONS>>>{valid_annotation_json}<<<CI-RESCUE-ANNOTATIONS>>>"
+
+    comment, annotations = parse_analysis(analysis_text)
+
+    assert comment == "This is the analysis."
+    assert annotations is not None
+    assert len(annotations) == 1
+    assert annotations[0]["path"] == "src/main.py"
+
+
+def test_parse_analysis_no_annotations():
+    """Test parsing analysis with no annotation block"""
+    analysis_text = "This is a simple analysis with no annotations."
+    comment, annotations = parse_analysis(analysis_text)
+    assert comment == analysis_text
+    assert annotations is None
+
+
+def test_parse_analysis_malformed_json():
+    """Test parsing analysis with malformed JSON in the annotation block"""
+    malformed_json = (
+        '{"annotations": [{"path": "file.py"}]'  # Missing closing brace
+    )
+    analysis_text = f"Analysis.<<<CI-RESCUE-ANNOTATIONS>>>{malformed_json}<<<CI-RESCUE-ANNOTATIONS>>>"
+
+    comment, annotations = parse_analysis(analysis_text)
+    assert "Analysis." in comment
+    assert malformed_json in comment  # Should return the original text
+    assert annotations is None
+
+
+def test_run_with_annotations(clients, fresh_rescue):
+    """Test the main run loop correctly calls annotation methods"""
+    github, openrouter = clients
+    # Mock failure data and PR
+    github.get_workflow_run_failures.return_value = [
+        FailureInfo("job", "step", "err", "log", "fail")
+    ]
+    github.get_pull_request.return_value = SimpleNamespace(number=123, title="Fix parser")
+
+    # Mock AI response with annotations
+    annotation_json = """{
+      "annotations": [{"path": "test.py", "start_line": 1, "message": "failure"}]
+    }"""
+    ai_response = f"Analysis here.<<<CI-RESCUE-ANNOTATIONS>>>{annotation_json}<<<CI-RESCUE-ANNOTATIONS>>>"
+    openrouter.analyze_failure.return_value = ai_response
+
+    fresh_rescue.run()
+
+    # Verify that comment and line annotation methods were called
+    github.post_or_update_comment.assert_called_once()
+    github.post_line_annotations.assert_called_once()
+
+    # Check that the comment includes formatted annotations
+    comment_arg = github.post_or_update_comment.call_args[0][1]
+    assert "Code Annotations" in comment_arg
+    assert "test.py" in comment_arg
+
+    # Check that the parsed annotations are passed to line annotations as ReviewComments
+    review_comments_arg = github.post_line_annotations.call_args[0][1]
+    assert len(review_comments_arg) == 1
+    assert review_comments_arg[0]["path"] == "test.py"
+    assert review_comments_arg[0]["line"] == 1
+    assert "CI Rescue Analysis" in review_comments_arg[0]["body"]
+
+
+def test_run_analyzes_each_failed_job_once(clients, fresh_rescue):
+    """Test that every failed job gets one analysis and the results are combined"""
+    github, openrouter = clients
+    github.get_workflow_run_failures.return_value = [
+        FailureInfo("lint", "ruff", "err", "log", "failure"),
+        FailureInfo("lint", "mypy", "err", "log", "failure"),
+        FailureInfo("test", "pytest", "err", "log", "failure"),
+    ]
+    github.get_pull_request.return_value = SimpleNamespace(number=123, title="Fix parser")
+    openrouter.analyze_failure.side_effect = (
+        lambda failure, max_tokens: f"Analysis of {failure.job_name}/{failure.step_name}"
+    )
+
+    fresh_rescue.run()
+
+    analyzed = sorted(c[0][0].step_name for c in openrouter.analyze_failure.call_args_list)
+    assert analyzed == ["pytest", "ruff"]
+    comment_arg = github.post_or_update_comment.call_args[0][1]
+    assert "Analysis of lint/ruff\n\n---\n\nAnalysis of test/pytest" in comment_arg
+    # Only the step that was not analyzed is listed as an additional failure
+    assert comment_arg.endswith("**Additional Failures:**\n- **lint** → mypy (failure)")
+
+
+def test_run_without_failures_skips_pr_lookup(clients, fresh_rescue):
+    """Test that a green run returns without looking up the pull request"""
+    github, openrouter = clients
+    github.get_workflow_run_failures.return_value = []
+
+    fresh_rescue.run()
+
+    github.get_pull_request.assert_not_called()
+    openrouter.analyze_failure.assert_not_called()
+
+
+def test_run_one_step_per_job_has_no_additional_failures(clients, fresh_rescue):
+    """Test that jobs which were all analyzed are not listed again as additional failures"""
+    github, openrouter = clients
+    github.get_workflow_run_failures.return_value = [
+        FailureInfo("lint", "ruff", "err", "log", "failure"),
+        FailureInfo("test", "pytest", "err", "log", "failure"),
+    ]
+    github.get_pull_request.return_value = SimpleNamespace(number=123, title="Fix parser")
+    openrouter.analyze_failure.return_value = "Analysis"
+
+    fresh_rescue.run()
+
+    assert "Additional Failures" not in github.post_or_update_comment.call_args[0][1]
+
+
+def test_render_annotations_markdown():
+    """Test formatting annotations for inclusion in PR comment"""
+    annotations = [
+        {
+            "path": "test.py",
+            "start_line": 10,
+            "message": "Test error",
+            "annotation_level": "failure",
         }
-        
-        # Use a fresh mock for each test
-        self.patch_github = patch("github_client.GitHubClient")
-        self.patch_openrouter = patch("openrouter_client.OpenRouterClient")
-        
-        self.mock_github_class = self.patch_github.start()
-        self.mock_openrouter_class = self.patch_openrouter.start()
-        
-        self.mock_github_instance = self.mock_github_class.return_value
-        self.mock_openrouter_instance = self.mock_openrouter_class.return_value
-
-        with patch.dict(os.environ, self.env_vars):
-            self.rescue = CIRescue()
-            self.rescue.github = self.mock_github_instance
-            self.rescue.openrouter = self.mock_openrouter_instance
-
-    def tearDown(self):
-        self.patch_github.stop()
-        self.patch_openrouter.stop()
-    
-
-    def test_failure_scenario(self):
-        self.assertEqual(1, 2)
-
-    def test_init_missing_vars(self):
-        """Test initialization with missing environment variables"""
-        with patch.dict(os.environ, {}, clear=True):
-            with self.assertRaises(ValueError):
-                CIRescue()
-    
-    def test_init_success(self):
-        """Test successful initialization"""
-        with patch.dict(os.environ, self.env_vars):
-            self.assertIsInstance(self.rescue, CIRescue)
-            self.assertEqual(self.rescue.github_token, "test-token")
-            self.assertEqual(self.rescue.openrouter_api_key, "test-openrouter-key")
-            self.assertEqual(self.rescue.model, "test-model")
-            self.assertEqual(self.rescue.max_tokens, 500)
-
-    def test_parse_analysis_with_valid_annotations(self):
-        """Test parsing analysis with a valid annotation block"""
-        valid_annotation_json = """{
-          "annotations": [
-            {"path": "src/main.py", "start_line": 10, "message": "Test annotation"}
-          ]
-        }"""
-        analysis_text = f"This is the analysis.<<<CI-RESCUE-ANNOTATIONS>>>{valid_annotation_json}<<<CI-RESCUE-ANNOTATIONS>>>"
-        
-        comment, annotations = self.rescue._parse_analysis_with_annotations(
-            analysis_text
-        )
-        
-        self.assertEqual(comment, "This is the analysis.")
-        self.assertIsNotNone(annotations)
-        self.assertEqual(len(annotations), 1)
-        self.assertEqual(annotations[0]["path"], "src/main.py")
-
-    def test_parse_analysis_no_annotations(self):
-        """Test parsing analysis with no annotation block"""
-        analysis_text = "This is a simple analysis with no annotations."
-        comment, annotations = self.rescue._parse_analysis_with_annotations(
-            analysis_text
-        )
-        self.assertEqual(comment, analysis_text)
-        self.assertIsNone(annotations)
+    ]
+
+    formatted, _ = render_annotations(annotations)
+
+    expected = ("Code Annotations", "test.py", "Line 10", "Test error", "❌")  # ❌: failure emoji
+    missing = [fragment for fragment in expected if fragment not in formatted]
+    assert not missing, missing
+
+
+def test_render_annotations_review_comments():
+    """Test converting AI annotations to GitHub ReviewComment format"""
+    annotations = [
+        {
+            "path": "src/main.py",
+            "start_line": 10,
+            "message": "Test error message",
+            "annotation_level": "failure"
+        },
+        {
+            "path": "src/utils.py",
+            "line": 25,  # Test fallback to 'line' field
+            "message": "Warning message",
+            "annotation_level": "warning"
+        }
+    ]
+
+    _, review_comments = render_annotations(annotations)
+
+    # Verify structure
+    assert len(review_comments) == 2
+
+    # Test first comment
+    assert review_comments[0]['path'] == "src/main.py"
+    assert review_comments[0]['line'] == 10
+    assert "❌" in review_comments[0]['body']
+    assert "Test error message" in review_comments[0]['body']
+
+    # Test second comment
+    assert review_comments[1]['path'] == "src/utils.py"
+    assert review_comments[1]['line'] == 25
+    assert "⚠️" in review_comments[1]['body']
+    assert "Warning message" in review_comments[1]['body']
+
+
+def test_render_annotations_validation():
+    """Test annotation conversion with invalid data"""
+    # Test annotation without path - should be skipped
+    annotations = [
+        {"start_line": 10, "message": "No path"},
+        {"path": "valid.py", "start_line": 20, "message": "Valid"}
+    ]
+
+    _, review_comments = render_annotations(annotations)
+
+    # Only the valid annotation should be converted
+    assert len(review_comments) == 1
+    assert review_comments[0]['path'] == "valid.py"
+
+    # Test invalid line number - should be skipped
+    annotations = [
+        {"path": "test.py", "start_line": "invalid", "message": "Bad line"},
+        {"path": "valid.py", "start_line": 20, "message": "Valid"}
+    ]
+
+    _, review_comments = render_annotations(annotations)
+    assert len(review_comments) == 1
+    assert review_comments[0]['path'] == "valid.py"
+
+
+# FailureInfo
+
+def test_failure_info_creation():
+    """Test creating FailureInfo instance"""
+    failure = SAMPLE_FAILURE
+
+    assert dataclasses.astuple(failure) == (
+        "test-job", "test-step", "test error", "test logs", "failure", "", ""
+    )
 
-    def test_parse_analysis_malformed_json(self):
-        """Test parsing analysis with malformed JSON in the annotation block"""
-        malformed_json = (
-            '{"annotations": [{"path": "file.py"}]'  # Missing closing brace
-        )
-        analysis_text = f"Analysis.<<<CI-RESCUE-ANNOTATIONS>>>{malformed_json}<<<CI-RESCUE-ANNOTATIONS>>>"
-        
-        comment, annotations = self.rescue._parse_analysis_with_annotations(
-            analysis_text
-        )
-        self.assertIn("Analysis.", comment)
-        self.assertIn(malformed_json, comment)  # Should return the original text
-        self.assertIsNone(annotations)
-
-    def test_run_with_annotations(self):
-        """Test the main run loop correctly calls annotation methods"""
-        # Mock failure data and PR
-        self.mock_github_instance.get_workflow_run_failures.return_value = [
-            FailureInfo("job", "step", "err", "log", "fail")
-        ]
-        mock_pr = Mock()
-        mock_pr.number = 123
-        self.mock_github_instance.get_pull_request.return_value = mock_pr
-        
-        # Mock AI response with annotations
-        annotation_json = """{
-          "annotations": [{"path": "test.py", "start_line": 1, "message": "failure"}]
-        }"""
-        ai_response = f"Analysis here.<<<CI-RESCUE-ANNOTATIONS>>>{annotation_json}<<<CI-RESCUE-ANNOTATIONS>>>"
-        self.mock_openrouter_instance.analyze_failure.return_value = ai_response
-
-        self.rescue.run()
-
-        # Verify that comment and line annotation methods were called
-        self.mock_github_instance.post_or_update_comment.assert_called_once()
-        self.mock_github_instance.post_line_annotations.assert_called_once()
-        
-        # Check that the comment includes formatted annotations
-        comment_arg = self.mock_github_instance.post_or_update_comment.call_args[0][1]
-        self.assertIn("Code Annotations", comment_arg)
-        self.assertIn("test.py", comment_arg)
-        
-        # Check that the parsed annotations are passed to line annotations as ReviewComments
-        review_comments_arg = self.mock_github_instance.post_line_annotations.call_args[0][1]
-        self.assertEqual(len(review_comments_arg), 1)
-        self.assertEqual(review_comments_arg[0]["path"], "test.py")
-        self.assertEqual(review_comments_arg[0]["line"], 1)
-        self.assertIn("body", review_comments_arg[0])
-        self.assertIn("CI Rescue Analysis", review_comments_arg[0]["body"])
-        
-    def test_format_annotations_for_comment(self):
-        """Test formatting annotations for inclusion in PR comment"""
-        annotations = [
-            {
-                "path": "test.py",
-                "start_line": 10,
-                "message": "Test error",
-                "annotation_level": "failure",
-            }
-        ]
-        
-        formatted = self.rescue.format_annotations_for_comment(annotations)
-        
-        self.assertIn("Code Annotations", formatted)
-        self.assertIn("test.py", formatted)
-        self.assertIn("Line 10", formatted)
-        self.assertIn("Test error", formatted)
-        self.assertIn("❌", formatted)  # failure emoji
-
-    def test_convert_annotations_to_review_comments(self):
-        """Test converting AI annotations to GitHub ReviewComment format"""  
-        annotations = [
-            {
-                "path": "src/main.py",
-                "start_line": 10,
-                "message": "Test error message",
-                "annotation_level": "failure"
-            },
-            {
-                "path": "src/utils.py", 
-                "line": 25,  # Test fallback to 'line' field
-                "message": "Warning message",
-                "annotation_level": "warning"
-            }
-        ]
-        
-        review_comments = self.rescue.convert_annotations_to_review_comments(annotations)
-        
-        # Verify structure
-        self.assertEqual(len(review_comments), 2)
-        
-        # Test first comment
-        self.assertEqual(review_comments[0]['path'], "src/main.py")
-        self.assertEqual(review_comments[0]['line'], 10)
-        self.assertIn("❌", review_comments[0]['body'])
-        self.assertIn("Test error message", review_comments[0]['body'])
-        
-        # Test second comment  
-        self.assertEqual(review_comments[1]['path'], "src/utils.py")
-        self.assertEqual(review_comments[1]['line'], 25)
-        self.assertIn("⚠️", review_comments[1]['body'])
-        self.assertIn("Warning message", review_comments[1]['body'])
-
-    def test_convert_annotations_validation(self):
-        """Test annotation conversion with invalid data"""
-        # Test annotation without path - should be skipped
-        annotations = [
-            {"start_line": 10, "message": "No path"},
-            {"path": "valid.py", "start_line": 20, "message": "Valid"}
-        ]
-        
-        review_comments = self.rescue.convert_annotations_to_review_comments(annotations)
-        
-        # Only the valid annotation should be converted
-        self.assertEqual(len(review_comments), 1)
-        self.assertEqual(review_comments[0]['path'], "valid.py")
-        
-        # Test invalid line number - should be skipped
-        annotations = [
-            {"path": "test.py", "start_line": "invalid", "message": "Bad line"},
-            {"path": "valid.py", "start_line": 20, "message": "Valid"}
-        ]
-        
-        review_comments = self.rescue.convert_annotations_to_review_comments(annotations)
-        self.assertEqual(len(review_comments), 1)
-        self.assertEqual(review_comments[0]['path'], "valid.py")
-
-
-class TestFailureInfo(unittest.TestCase):
-    """Test FailureInfo dataclass"""
-    
-    def test_creation(self):
-        """Test creating FailureInfo instance"""
-        failure = FailureInfo(
-            job_name="test-job",
-            step_name="test-step",
-            error_message="test error",
-            logs="test logs", 
-            conclusion="failure",
-        )
-        
-        self.assertEqual(failure.job_name, "test-job")
-        self.assertEqual(failure.step_name, "test-step")
-        self.assertEqual(failure.error_message, "test error")
-        self.assertEqual(failure.logs, "test logs")
-        self.assertEqual(failure.conclusion, "failure")
 
+def test_failure_info_frozen():
+    """Test that FailureInfo is immutable and hashable"""
+    failure = SAMPLE_FAILURE
 
-if __name__ == "__main__":
-    unittest.main()
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        failure.logs = "other logs"
+    assert hash(failure) == hash(dataclasses.replace(failure))